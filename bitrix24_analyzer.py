@@ -4,21 +4,253 @@
 Проверяет доступность методов и считает объёмы данных
 """
 
+import sys
 import requests
 import json
 from datetime import datetime
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Tuple
+from urllib.parse import urlencode
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import sqlite3
+import hashlib
+import argparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# orjson заметно быстрее stdlib json на больших ответах crm.*.list
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_loads(data: bytes) -> Any:
+    """Разобрать JSON-ответ (orjson, если установлен)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj: Any) -> bytes:
+    """Сериализовать объект в JSON (bytes)"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+def json_dump_file(obj: Any, path: str):
+    """Сохранить объект в JSON-файл с отступами"""
+    if orjson is not None:
+        # years_data содержит int-ключи - нужен OPT_NON_STR_KEYS
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        return
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, ensure_ascii=False, indent=2)
+
+# Параллельные пробы; лимит Битрикс24 - 2 запроса в секунду
+MAX_WORKERS = 8
+REQUESTS_PER_SEC = 2
+# HTTP-статусы, которые считаются временными и повторяются
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Максимум подкоманд в одном вызове batch
+BATCH_LIMIT = 50
+# Локальный кэш ответов (повторные запуски анализа без сети)
+CACHE_PATH = '.b24_cache.db'
+CACHE_TTL = 3600
+
+# Годы для распределения сделок: (год, начало, начало следующего года)
+YEAR_RANGES = tuple((year, f'{year}-01-01', f'{year + 1}-01-01') for year in range(2021, 2026))
+
+# Разделители отчёта
+SEPARATOR = "=" * 80 + "\n"
+SUBSEPARATOR = "-" * 80 + "\n"
+
+# Ключевые поля для примера структуры сделки
+KEY_FIELDS = ('ID', 'TITLE', 'STAGE_ID', 'OPPORTUNITY', 'CURRENCY_ID',
+              'DATE_CREATE', 'CLOSEDATE', 'ASSIGNED_BY_ID', 'SOURCE_ID')
+
+# Типы активностей: (название, TYPE_ID)
+ACTIVITY_TYPES = (
+    ('📞 Звонки', 2),
+    ('✉️ Email', 4),
+    ('📅 Встречи', 1),
+    ('✅ Задачи', 3),
+)
+
+
+def flatten_params(params: Dict, prefix: str = '') -> List[Tuple[str, Any]]:
+    """Развернуть вложенные параметры в синтаксис Битрикс24: filter[>=DATE_CREATE]=..."""
+    items = []
+    for key, value in params.items():
+        name = f'{prefix}[{key}]' if prefix else str(key)
+        if isinstance(value, dict):
+            items.extend(flatten_params(value, name))
+        elif isinstance(value, (list, tuple)):
+            for i, item in enumerate(value):
+                items.append((f'{name}[{i}]', item))
+        else:
+            items.append((name, value))
+    return items
+
+
+@lru_cache(maxsize=None)
+def year_count_cmds(method: str, date_field: str) -> Dict[int, str]:
+    """Готовые строки batch-подкоманд для подсчёта записей по годам (кодируются один раз)"""
+    # Ключи filter[>=...] кодируются: Битрикс24 разбирает подкоманду через parse_str,
+    # и сырой '=' в ключе обрезал бы фильтр
+    return {
+        year: f"{method}?" + urlencode(flatten_params(count_only_params({
+            'filter': {f'>={date_field}': date_from, f'<{date_field}': date_to}
+        })))
+        for year, date_from, date_to in YEAR_RANGES
+    }
+
+
+def count_only_params(params: Optional[Dict]) -> Dict:
+    """Параметры для запроса только total: одно поле ID вместо полных строк"""
+    return {**(params or {}), 'select': ['ID'], 'start': 0}
+
+
+class RateLimiter:
+    """Простой потокобезопасный ограничитель частоты запросов"""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        """Дождаться разрешения на следующий запрос"""
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ProbeCache:
+    """Локальный SQLite-кэш ответов Битрикс24 с TTL"""
+
+    def __init__(self, path: str, ttl: float):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, ts REAL, blob BLOB)')
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(method: str, params: Optional[Dict]) -> str:
+        """Ключ кэша: хэш от метода и параметров"""
+        raw = f"{method}|{json.dumps(params or {}, sort_keys=True, default=str)}"
+        return hashlib.blake2b(raw.encode('utf-8'), digest_size=16).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[Any, bool]]:
+        """Вернуть (данные, свежие ли) или None, если записи нет"""
+        with self.lock:
+            row = self.conn.execute('SELECT ts, blob FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        ts, blob = row
+        return json_loads(blob), time.time() - ts < self.ttl
+
+    def set(self, key: str, data: Any):
+        """Сохранить ответ в кэш"""
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO cache (key, ts, blob) VALUES (?, ?, ?)',
+                (key, time.time(), json_dumps(data))
+            )
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
 
 class Bitrix24Analyzer:
-    def __init__(self, webhook_url: str):
+    def __init__(self, webhook_url: str, cache_path: Optional[str] = CACHE_PATH, cache_ttl: float = CACHE_TTL):
         self.webhook = webhook_url.rstrip('/')
-        
-    def check_method(self, method: str, params: Dict = None) -> Dict[str, Any]:
-        """Проверка доступности метода и получение данных"""
+        # Базовый URL не меняется за время жизни анализатора - собираем один раз
+        self.base_url = self.webhook + '/'
+        self.rate_limiter = RateLimiter(REQUESTS_PER_SEC)
+        self.cache = ProbeCache(cache_path, cache_ttl) if cache_path else None
+
+        # Одна keep-alive сессия на все запросы: без нового TCP+TLS на каждый вызов
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Accept-Encoding': 'gzip',
+            'Connection': 'keep-alive',
+        })
+        # Временные 429/5xx повторяем с экспоненциальной паузой (и с учётом Retry-After),
+        # чтобы один сбой не портил весь отчёт
+        retry = Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset(['GET', 'POST']),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS, max_retries=retry)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        """Закрыть HTTP-сессию и кэш"""
+        self.session.close()
+        if self.cache:
+            self.cache.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        
+    def request_json(self, method: str, params: Optional[Dict] = None, post: bool = False) -> Dict[str, Any]:
+        """Запрос к API через кэш; при ошибке сети отдаём устаревшую запись, если она есть"""
+        key = ProbeCache.make_key(method, params) if self.cache else None
+        cached = self.cache.get(key) if self.cache else None
+        if cached and cached[1]:
+            return cached[0]
+
+        url = self.base_url + method + '.json'
         try:
-            url = f"{self.webhook}/{method}.json"
-            response = requests.get(url, params=params or {}, timeout=30)
-            data = response.json()
+            self.rate_limiter.wait()
+            # stream=True + with: тело читается один раз прямо в парсер,
+            # соединение сразу возвращается в пул
+            if post:
+                response = self.session.post(url, json=params or {}, timeout=30, stream=True)
+            else:
+                # Вложенные filter/select requests кодирует неверно - кодируем сами
+                query = urlencode(flatten_params(params or {}))
+                response = self.session.get(f"{url}?{query}" if query else url, timeout=30, stream=True)
+            with response:
+                # Повторы исчерпаны - это сбой сервера, а не ответ метода
+                if response.status_code in RETRY_STATUSES:
+                    raise requests.exceptions.RetryError(
+                        f"HTTP {response.status_code} after retries"
+                    )
+                data = json_loads(response.raw.read(decode_content=True))
+        except Exception:
+            if cached:
+                return cached[0]
+            raise
+
+        if self.cache and 'error' not in data:
+            self.cache.set(key, data)
+        return data
+
+    def check_method(self, method: str, params: Dict = None, count_only: bool = False) -> Dict[str, Any]:
+        """Проверка доступности метода и получение данных (count_only - только total, без строк)"""
+        try:
+            if count_only:
+                params = count_only_params(params)
+            data = self.request_json(method, params)
             
             if 'error' in data:
                 return {
@@ -30,6 +262,15 @@ class Bitrix24Analyzer:
             total = data.get('total', 0)
             results = data.get('result', [])
             
+            if count_only:
+                return {
+                    'method': method,
+                    'available': True,
+                    'total': total,
+                    'returned': 0,
+                    'sample': None
+                }
+            
             return {
                 'method': method,
                 'available': True,
@@ -50,229 +291,274 @@ class Bitrix24Analyzer:
                 'error': str(e)
             }
     
+    def batch(self, cmds: Dict[Any, Tuple[str, Optional[Dict]]], count_only: bool = True) -> Dict[Any, Dict[str, Any]]:
+        """Выполнить несколько проверок одним запросом batch.json (до 50 подкоманд за вызов)"""
+        if count_only:
+            cmds = {key: (method, count_only_params(params)) for key, (method, params) in cmds.items()}
+        encoded = {
+            key: f"{method}?{urlencode(flatten_params(params or {}))}"
+            for key, (method, params) in cmds.items()
+        }
+        return self.batch_encoded(encoded, count_only)
+
+    def batch_encoded(self, encoded: Dict[Any, str], count_only: bool = True) -> Dict[Any, Dict[str, Any]]:
+        """batch.json по готовым строкам подкоманд вида 'method?query'"""
+        keys = list(encoded)
+        results = {}
+        for i in range(0, len(keys), BATCH_LIMIT):
+            chunk = keys[i:i + BATCH_LIMIT]
+            # Ключи подкоманд должны быть строками, исходные ключи восстанавливаем по ним
+            names = {str(key): key for key in chunk}
+            methods = {key: encoded[key].split('?', 1)[0] for key in chunk}
+            body = {
+                'halt': 0,
+                'cmd': {name: encoded[key] for name, key in names.items()}
+            }
+            try:
+                data = self.request_json('batch', body, post=True)
+
+                if 'error' in data:
+                    error = data.get('error_description', data.get('error'))
+                    for key in chunk:
+                        results[key] = {'method': methods[key], 'available': False, 'error': error}
+                    continue
+
+                batch_result = data.get('result', {})
+                # Пустые словари PHP приходят как списки
+                sub_results = batch_result.get('result') or {}
+                sub_totals = batch_result.get('result_total') or {}
+                sub_errors = batch_result.get('result_error') or {}
+
+                for name, key in names.items():
+                    method = methods[key]
+                    if name in sub_errors:
+                        error = sub_errors[name]
+                        results[key] = {
+                            'method': method,
+                            'available': False,
+                            'error': error.get('error_description', error.get('error')) if isinstance(error, dict) else error
+                        }
+                        continue
+                    rows = [] if count_only else sub_results.get(name, [])
+                    results[key] = {
+                        'method': method,
+                        'available': True,
+                        'total': sub_totals.get(name, 0),
+                        'returned': len(rows) if isinstance(rows, list) else 0,
+                        'sample': rows[:1] if isinstance(rows, list) and rows else None
+                    }
+            except requests.exceptions.Timeout:
+                for key in chunk:
+                    results[key] = {'method': methods[key], 'available': False, 'error': 'Timeout (30s)'}
+            except Exception as e:
+                for key in chunk:
+                    results[key] = {'method': methods[key], 'available': False, 'error': str(e)}
+        return results
+    
     def get_date_range_counts(self, method: str, date_field: str = 'DATE_CREATE') -> Dict[int, int]:
-        """Получение количества записей по годам"""
+        """Получение количества записей по годам (все годы одним batch-запросом)"""
         years = {}
-        for year in [2021, 2022, 2023, 2024, 2025]:
-            params = {
-                'filter': {
-                    f'>={date_field}': f'{year}-01-01',
-                    f'<{date_field}': f'{year+1}-01-01'
-                }
-            }
-            result = self.check_method(method, params)
+        for year, result in self.batch_encoded(year_count_cmds(method, date_field)).items():
             if result['available']:
                 years[year] = result['total']
         return years
     
-    def analyze(self) -> Dict[str, Any]:
-        """Полный анализ Битрикс24"""
-        
-        print("=" * 80)
-        print("АНАЛИЗ БИТРИКС24 ДЛЯ ETL И ИИ-АНАЛИТИКИ")
-        print("=" * 80)
-        print(f"Вебхук: {self.webhook}")
-        print(f"Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        print("=" * 80)
-        print()
-        
-        # 1. Проверка основных методов CRM
-        print("1️⃣  ПРОВЕРКА ДОСТУПНОСТИ МЕТОДОВ CRM")
-        print("-" * 80)
-        
-        methods = {
-            'Сделки': 'crm.deal.list',
-            'Активности': 'crm.activity.list',
-            'Контакты': 'crm.contact.list',
-            'Компании': 'crm.company.list',
-            'Лиды': 'crm.lead.list',
-            'Таймлайн': 'crm.timeline.list',
-            'Звонки': 'crm.activity.list',
-            'Email': 'crm.activity.list',
+    def _gather(self) -> Dict[str, Any]:
+        """Собрать все результаты проверок (без вывода на экран)"""
+        # Все независимые пробы отправляем параллельно
+        # Для сделок нужен пример записи, остальным достаточно total
+        probes = {
+            'deals': ('crm.deal.list', None, False),
+            'contacts': ('crm.contact.list', None, True),
+            'companies': ('crm.company.list', None, True),
+            'leads': ('crm.lead.list', None, True),
+            'calls_stats': ('voximplant.statistic.get', None, False),
+            'users': ('user.get', None, False),
         }
-        
-        results = {}
-        
-        # Проверка сделок
-        print("Сделки (crm.deal.list)...", end=' ')
-        deals = self.check_method('crm.deal.list')
-        results['deals'] = deals
-        if deals['available']:
-            print(f"✅ {deals['total']:,} записей")
-        else:
-            print(f"❌ {deals.get('error')}")
-        
-        # Проверка всех активностей
-        print("Активности - ВСЕ (crm.activity.list)...", end=' ')
-        activities = self.check_method('crm.activity.list')
-        results['activities_all'] = activities
-        if activities['available']:
-            print(f"✅ {activities['total']:,} записей")
-        else:
-            print(f"❌ {activities.get('error')}")
-        
+        # Все активности и разбивка по типам - одним batch-запросом вместо пяти.
+        # Сумма по 4 типам не равна общему числу (есть и другие TYPE_ID), поэтому
+        # общий total запрашиваем отдельной подкомандой того же batch
+        activity_cmds = {'activities_all': ('crm.activity.list', None)}
+        activity_cmds.update({
+            f'activities_type_{type_id}': ('crm.activity.list', {'filter': {'TYPE_ID': type_id}})
+            for _, type_id in ACTIVITY_TYPES
+        })
+
+        # Одиночные пробы и оба batch-запроса летят одновременно по пулу keep-alive
+        # соединений. Подсчёт по годам запускаем сразу, не дожидаясь total сделок,
+        # и отбрасываем, если сделок нет
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {
+                key: executor.submit(self.check_method, method, params, count_only)
+                for key, (method, params, count_only) in probes.items()
+            }
+            activities_future = executor.submit(self.batch, activity_cmds)
+            years_future = executor.submit(self.get_date_range_counts, 'crm.deal.list', 'DATE_CREATE')
+
+            results = {key: future.result() for key, future in futures.items()}
+            results.update(activities_future.result())
+            years_data = years_future.result()
+
+        # Распределение по годам имеет смысл только если сделки есть
+        deals = results['deals']
+        if deals['available'] and deals['total'] > 0:
+            results['deals_by_year'] = years_data
+
+        return results
+
+    @staticmethod
+    def _status_line(label: str, result: Dict[str, Any], unit: str = 'записей') -> str:
+        """Строка статуса проверки: '<label>... ✅ N записей' или ошибка"""
+        if result['available']:
+            return f"{label}... ✅ {result['total']:,} {unit}\n"
+        return f"{label}... ❌ {result.get('error')}\n"
+
+    def _render(self, results: Dict[str, Any], generated_at: str) -> str:
+        """Сформировать текстовый отчёт по собранным результатам"""
+        out = []
+        line = out.append
+
+        line(SEPARATOR)
+        line("АНАЛИЗ БИТРИКС24 ДЛЯ ETL И ИИ-АНАЛИТИКИ\n")
+        line(SEPARATOR)
+        line(f"Вебхук: {self.webhook}\n")
+        line(f"Время: {generated_at}\n")
+        line(SEPARATOR)
+        line("\n")
+
+        deals = results['deals']
+        activities = results['activities_all']
+        contacts = results['contacts']
+
+        # 1. Проверка основных методов CRM
+        line("1️⃣  ПРОВЕРКА ДОСТУПНОСТИ МЕТОДОВ CRM\n")
+        line(SUBSEPARATOR)
+
+        line(self._status_line("Сделки (crm.deal.list)", deals))
+        line(self._status_line("Активности - ВСЕ (crm.activity.list)", activities))
+
         # Разбивка активностей по типам
         if activities['available']:
-            activity_types = {
-                '📞 Звонки': 2,
-                '✉️ Email': 4,
-                '📅 Встречи': 1,
-                '✅ Задачи': 3,
-            }
-            
-            for name, type_id in activity_types.items():
-                params = {'filter': {'TYPE_ID': type_id}}
-                result = self.check_method('crm.activity.list', params)
-                results[f'activities_type_{type_id}'] = result
+            for name, type_id in ACTIVITY_TYPES:
+                result = results[f'activities_type_{type_id}']
                 if result['available']:
-                    print(f"  {name}: {result['total']:,} записей")
-        
-        # Контакты
-        print("Контакты (crm.contact.list)...", end=' ')
-        contacts = self.check_method('crm.contact.list')
-        results['contacts'] = contacts
-        if contacts['available']:
-            print(f"✅ {contacts['total']:,} записей")
-        else:
-            print(f"❌ {contacts.get('error')}")
-        
-        # Компании
-        print("Компании (crm.company.list)...", end=' ')
-        companies = self.check_method('crm.company.list')
-        results['companies'] = companies
-        if companies['available']:
-            print(f"✅ {companies['total']:,} записей")
-        else:
-            print(f"❌ {companies.get('error')}")
-        
-        # Лиды
-        print("Лиды (crm.lead.list)...", end=' ')
-        leads = self.check_method('crm.lead.list')
-        results['leads'] = leads
-        if leads['available']:
-            print(f"✅ {leads['total']:,} записей")
-        else:
-            print(f"❌ {leads.get('error')}")
-        
-        print()
-        
+                    line(f"  {name}: {result['total']:,} записей\n")
+
+        line(self._status_line("Контакты (crm.contact.list)", contacts))
+        line(self._status_line("Компании (crm.company.list)", results['companies']))
+        line(self._status_line("Лиды (crm.lead.list)", results['leads']))
+        line("\n")
+
         # 2. Проверка телефонии
-        print("2️⃣  ПРОВЕРКА ТЕЛЕФОНИИ")
-        print("-" * 80)
-        
-        print("Статистика звонков (voximplant.statistic.get)...", end=' ')
-        calls_stats = self.check_method('voximplant.statistic.get')
-        results['calls_stats'] = calls_stats
+        line("2️⃣  ПРОВЕРКА ТЕЛЕФОНИИ\n")
+        line(SUBSEPARATOR)
+
+        calls_stats = results['calls_stats']
         if calls_stats['available']:
-            print(f"✅ Доступна")
+            line("Статистика звонков (voximplant.statistic.get)... ✅ Доступна\n")
         else:
-            print(f"❌ {calls_stats.get('error', 'Недоступна')}")
-        
-        print()
-        
+            line(f"Статистика звонков (voximplant.statistic.get)... ❌ {calls_stats.get('error', 'Недоступна')}\n")
+        line("\n")
+
         # 3. Проверка пользователей
-        print("3️⃣  ПРОВЕРКА ПОЛЬЗОВАТЕЛЕЙ")
-        print("-" * 80)
-        
-        print("Пользователи (user.get)...", end=' ')
-        users = self.check_method('user.get')
-        results['users'] = users
-        if users['available']:
-            print(f"✅ {users['total']:,} пользователей")
-        else:
-            print(f"❌ {users.get('error')}")
-        
-        print()
-        
+        line("3️⃣  ПРОВЕРКА ПОЛЬЗОВАТЕЛЕЙ\n")
+        line(SUBSEPARATOR)
+        line(self._status_line("Пользователи (user.get)", results['users'], 'пользователей'))
+        line("\n")
+
         # 4. Анализ по годам
-        if deals['available'] and deals['total'] > 0:
-            print("4️⃣  РАСПРЕДЕЛЕНИЕ СДЕЛОК ПО ГОДАМ")
-            print("-" * 80)
-            print("Подсчёт сделок по годам (это займёт ~10 секунд)...")
-            
-            years_data = self.get_date_range_counts('crm.deal.list', 'DATE_CREATE')
-            for year, count in sorted(years_data.items()):
+        if 'deals_by_year' in results:
+            line("4️⃣  РАСПРЕДЕЛЕНИЕ СДЕЛОК ПО ГОДАМ\n")
+            line(SUBSEPARATOR)
+            for year, count in sorted(results['deals_by_year'].items()):
                 if count > 0:
                     bar = '█' * min(50, count // 100)
-                    print(f"{year}: {count:>6,} {bar}")
-            
-            results['deals_by_year'] = years_data
-            print()
-        
+                    line(f"{year}: {count:>6,} {bar}\n")
+            line("\n")
+
         # 5. Оценка времени выгрузки
-        print("5️⃣  ОЦЕНКА ВРЕМЕНИ ПОЛНОЙ ВЫГРУЗКИ")
-        print("-" * 80)
-        
+        line("5️⃣  ОЦЕНКА ВРЕМЕНИ ПОЛНОЙ ВЫГРУЗКИ\n")
+        line(SUBSEPARATOR)
+
         total_records = 0
-        
+
         if deals['available']:
             total_records += deals['total']
-            print(f"Сделки: {deals['total']:,} записей")
-        
+            line(f"Сделки: {deals['total']:,} записей\n")
+
         if activities['available']:
             total_records += activities['total']
-            print(f"Активности: {activities['total']:,} записей")
-        
+            line(f"Активности: {activities['total']:,} записей\n")
+
         if contacts['available']:
             total_records += contacts['total']
-            print(f"Контакты: {contacts['total']:,} записей")
-        
+            line(f"Контакты: {contacts['total']:,} записей\n")
+
         # Лимиты Битрикс24: 2 req/sec, 50 записей за запрос
         # Консервативно: 80 записей в секунду
         records_per_sec = 80
-        
+
         total_seconds = total_records / records_per_sec
         total_minutes = total_seconds / 60
         total_hours = total_minutes / 60
-        
-        print()
-        print(f"📊 ВСЕГО ЗАПИСЕЙ: {total_records:,}")
-        print(f"⏱️  Ожидаемое время: ~{total_minutes:.0f} минут ({total_hours:.1f} часов)")
-        print()
-        
+
+        line("\n")
+        line(f"📊 ВСЕГО ЗАПИСЕЙ: {total_records:,}\n")
+        line(f"⏱️  Ожидаемое время: ~{total_minutes:.0f} минут ({total_hours:.1f} часов)\n")
+        line("\n")
+
         # Рекомендации
-        print("6️⃣  РЕКОМЕНДАЦИИ")
-        print("-" * 80)
-        
+        line("6️⃣  РЕКОМЕНДАЦИИ\n")
+        line(SUBSEPARATOR)
+
         if total_hours > 12:
-            print("⚠️  Данных МНОГО! Рекомендуется:")
-            print("   • Разбить выгрузку на части (по годам)")
-            print("   • Использовать параллельную выгрузку")
-            print("   • Запускать выгрузку ночью")
+            line("⚠️  Данных МНОГО! Рекомендуется:\n")
+            line("   • Разбить выгрузку на части (по годам)\n")
+            line("   • Использовать параллельную выгрузку\n")
+            line("   • Запускать выгрузку ночью\n")
         elif total_hours > 4:
-            print("📋 Средний объём данных:")
-            print("   • Выгрузка займёт несколько часов")
-            print("   • Рекомендуется запускать в фоне")
+            line("📋 Средний объём данных:\n")
+            line("   • Выгрузка займёт несколько часов\n")
+            line("   • Рекомендуется запускать в фоне\n")
         else:
-            print("✅ Объём данных небольшой, выгрузка быстрая")
-        
-        print()
-        
+            line("✅ Объём данных небольшой, выгрузка быстрая\n")
+
+        line("\n")
+
         # 7. Пример структуры данных
         if deals['available'] and deals.get('sample'):
-            print("7️⃣  ПРИМЕР СТРУКТУРЫ СДЕЛКИ")
-            print("-" * 80)
+            line("7️⃣  ПРИМЕР СТРУКТУРЫ СДЕЛКИ\n")
+            line(SUBSEPARATOR)
             sample_deal = deals['sample'][0]
-            
+
             # Показываем ключевые поля
-            key_fields = ['ID', 'TITLE', 'STAGE_ID', 'OPPORTUNITY', 'CURRENCY_ID', 
-                         'DATE_CREATE', 'CLOSEDATE', 'ASSIGNED_BY_ID', 'SOURCE_ID']
-            
-            for field in key_fields:
-                if field in sample_deal:
-                    value = sample_deal[field]
-                    if isinstance(value, str) and len(value) > 60:
-                        value = value[:60] + '...'
-                    print(f"  {field}: {value}")
-            
-            print()
-            print("  [Полная структура сохранена в raw_data]")
-        
-        print()
-        print("=" * 80)
-        print("✅ АНАЛИЗ ЗАВЕРШЁН")
-        print("=" * 80)
-        
+            for field in KEY_FIELDS:
+                value = sample_deal.get(field)
+                if value is None:
+                    continue
+                if isinstance(value, str) and len(value) > 60:
+                    value = value[:60] + '...'
+                line(f"  {field}: {value}\n")
+
+            line("\n")
+            line("  [Полная структура сохранена в raw_data]\n")
+
+        line("\n")
+        line(SEPARATOR)
+        line("✅ АНАЛИЗ ЗАВЕРШЁН\n")
+        line(SEPARATOR)
+
+        return ''.join(out)
+
+    def analyze(self) -> Dict[str, Any]:
+        """Полный анализ Битрикс24: сначала сбор данных, затем один вывод отчёта"""
+        generated_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        print("⏳ Сбор данных из Битрикс24...", flush=True)
+        results = self._gather()
+
+        sys.stdout.write(self._render(results, generated_at))
+        sys.stdout.flush()
+
         return results
 
 
@@ -280,12 +566,17 @@ if __name__ == '__main__':
     # Ваш вебхук
     WEBHOOK_URL = "https://gsmural.bitrix24.ru/rest/12/120rlt4osdrdtv5a/"
     
-    analyzer = Bitrix24Analyzer(WEBHOOK_URL)
-    results = analyzer.analyze()
+    parser = argparse.ArgumentParser(description='Анализ данных Битрикс24')
+    parser.add_argument('--no-cache', action='store_true', help='Не использовать локальный кэш ответов')
+    parser.add_argument('--ttl', type=float, default=CACHE_TTL, help='Время жизни кэша, секунд')
+    args = parser.parse_args()
+    
+    cache_path = None if args.no_cache else CACHE_PATH
+    with Bitrix24Analyzer(WEBHOOK_URL, cache_path=cache_path, cache_ttl=args.ttl) as analyzer:
+        results = analyzer.analyze()
     
     # Сохраняем результаты в JSON
-    with open('bitrix24_analysis.json', 'w', encoding='utf-8') as f:
-        json.dump(results, f, ensure_ascii=False, indent=2)
+    json_dump_file(results, 'bitrix24_analysis.json')
     
     print()
     print("📄 Результаты сохранены в bitrix24_analysis.json")
@@ -6,12 +6,42 @@ Bitrix24 ETL Service - ФИНАЛЬНАЯ ВЕРСИЯ
 
 import os
 import sys
+import json
+import gzip
+import hashlib
 import time
 import logging
-from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, List
-import requests
+import threading
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache, partial
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Dict, Any, List, Iterator
+from urllib.parse import urlencode
 from supabase import create_client, Client
+import httpx
+
+# orjson разбирает ответы Bitrix24 и сериализует батчи в разы быстрее stdlib json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# HTTP/2 для Bitrix24 и PostgREST доступен, только если установлен пакет h2
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# psycopg нужен только для быстрой загрузки через COPY в full sync
+try:
+    import psycopg
+    from psycopg import sql
+    from psycopg.types.json import Jsonb
+except ImportError:
+    psycopg = None
 
 # Настройка логирования
 logging.basicConfig(
@@ -30,6 +60,29 @@ SUPABASE_URL = os.getenv('SUPABASE_URL')
 SUPABASE_KEY = os.getenv('SUPABASE_KEY')
 SYNC_MODE = os.getenv('SYNC_MODE', 'incremental')  # По умолчанию incremental
 HOURS_BACK = int(os.getenv('HOURS_BACK', '24'))
+# Incremental продолжает с high-water mark прошлой синхронизации (HOURS_BACK - только если его нет)
+USE_HIGH_WATER = os.getenv('USE_HIGH_WATER', 'true').lower() in ('1', 'true', 'yes')
+# Запас high-water mark от начала обхода - на расхождение часов ETL и Битрикс24
+HIGH_WATER_SKEW = timedelta(minutes=5)
+# Лимиты Bitrix24: 2 запроса в секунду в среднем, до 50 запросов подряд
+BITRIX_RATE = 2
+BITRIX_BURST = 50
+# Сколько страниц Bitrix24 грузить параллельно (общий лимит частоты соблюдает TokenBucket)
+PAGE_WORKERS = 4
+PAGE_WINDOW = PAGE_WORKERS * 2  # Сколько запросов страниц может быть загружено впереди обработки
+BATCH_LIMIT = 50  # Максимум подкоманд в одном вызове batch.json
+BATCH_PAGES = 10  # Страниц списка (по 50 записей) в одном запросе batch.json
+# Прямое подключение к Postgres Supabase (опционально): в full sync данные грузятся через COPY
+SUPABASE_DB_URL = os.getenv('SUPABASE_DB_URL')
+# Таблицы с серверной функцией пакетного upsert (см. supabase_schema.sql)
+RPC_UPSERT = {'contacts': 'upsert_contacts'}
+# Сохранять полный исходный JSON записи в raw_data (false - только плоские колонки)
+STORE_RAW = os.getenv('STORE_RAW', 'true').lower() in ('1', 'true', 'yes')
+# Размер батча для upsert в Supabase (не больше 1000 - лимит размера запроса PostgREST)
+UPSERT_BATCH = min(int(os.getenv('UPSERT_BATCH', '500')), 1000)
+# Сжимать gzip тела upsert-запросов к PostgREST (JSON с повторяющимися ключами жмётся в разы)
+COMPRESS_UPLOADS = os.getenv('COMPRESS_UPLOADS', 'true').lower() in ('1', 'true', 'yes')
+GZIP_MIN_BYTES = 64 * 1024  # Маленькие тела не сжимаем - выигрыша нет
 
 # Проверка обязательных переменных
 if not all([BITRIX_WEBHOOK, SUPABASE_URL, SUPABASE_KEY]):
@@ -40,62 +93,576 @@ if not all([BITRIX_WEBHOOK, SUPABASE_URL, SUPABASE_KEY]):
     sys.exit(1)
 
 
+# ==================== ПРЕОБРАЗОВАНИЕ ТИПОВ ====================
+# Функции уровня модуля (а не staticmethod) - вызываются десятки раз на каждую запись
+
+_EMPTY_VALUES = frozenset({None, '', 'null'})
+_TRUE_VALUES = frozenset({'Y', 'YES', 'TRUE', '1', 'y', 'yes', 'true'})
+
+
+def safe_int(value: Any, default: Optional[int] = None) -> Optional[int]:
+    """Безопасное преобразование в int"""
+    # Быстрый путь: ID, OWNER_ID и т.п. Bitrix24 отдаёт строками из цифр -
+    # int() напрямую, без промежуточного float
+    cls = value.__class__
+    if cls is str and value.isascii() and value.isdigit():
+        return int(value)
+    if cls is int:
+        return value
+    try:
+        if value in _EMPTY_VALUES:
+            return default
+        return int(float(value))
+    except (ValueError, TypeError):
+        # TypeError также для нехэшируемых значений (list/dict)
+        return default
+
+
+def safe_float(value: Any, default: Optional[float] = None) -> Optional[float]:
+    """Безопасное преобразование в float"""
+    if value.__class__ is float:
+        return value
+    try:
+        if value in _EMPTY_VALUES:
+            return default
+        return float(value)
+    except (ValueError, TypeError):
+        return default
+
+
+def safe_datetime(value: Any) -> Optional[str]:
+    """Безопасное преобразование даты в ISO формат"""
+    # Короче 'YYYY-MM-DD' дата быть не может
+    if not isinstance(value, str) or len(value) < 10:
+        return None
+    # Быстрый путь: Bitrix24 отдаёт даты как 'YYYY-MM-DDTHH:MM:SS+03:00' - это уже
+    # канонический isoformat(), объект datetime создавать не нужно
+    if (len(value) == 25 and value[4] == '-' and value[7] == '-' and value[10] == 'T'
+            and value[13] == ':' and value[16] == ':' and value[19] in '+-'
+            and value[22] == ':' and value[:4].isdigit()):
+        return value
+    return parse_datetime(value)
+
+
+@lru_cache(maxsize=65536)
+def parse_datetime(value: str) -> Optional[str]:
+    """Разбор даты в остальных форматах ('Z', без времени); одни и те же даты повторяются - кэшируем"""
+    try:
+        dt = datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+        return dt.isoformat()
+    except ValueError:
+        return None
+
+
+def safe_bool(value: Any) -> bool:
+    """Безопасное преобразование в bool"""
+    cls = value.__class__
+    if cls is str:
+        # Bitrix24 отдаёт 'Y'/'N': односимвольные значения решаются поиском в множестве,
+        # upper() - только для длинных строк в смешанном регистре ('True', 'Yes')
+        return value in _TRUE_VALUES or (len(value) > 1 and value.upper() in _TRUE_VALUES)
+    if cls is bool:
+        return value
+    if value is None:
+        return False
+    return bool(value)
+
+
+def first_multifield(value: Any) -> Optional[str]:
+    """Первое значение мультиполя Bitrix24 (EMAIL, PHONE: [{'VALUE': ..., 'VALUE_TYPE': ...}, ...])"""
+    if value and isinstance(value, list):
+        return value[0].get('VALUE')
+    return None
+
+
+# ==================== СХЕМЫ ПОЛЕЙ ====================
+# (колонка, поле Bitrix24, конвертер или None[, значение вместо пустого])
+
+DEAL_FIELDS = [
+    ('id', 'ID', safe_int),
+    ('title', 'TITLE', None, None),
+    ('type_id', 'TYPE_ID', None, None),
+    ('category_id', 'CATEGORY_ID', safe_int),
+    ('stage_id', 'STAGE_ID', None, None),
+    ('stage_semantic_id', 'STAGE_SEMANTIC_ID', None, None),
+    ('opportunity', 'OPPORTUNITY', safe_float),
+    ('currency_id', 'CURRENCY_ID', None, 'RUB'),
+    ('tax_value', 'TAX_VALUE', safe_float),
+    ('company_id', 'COMPANY_ID', safe_int, None),
+    ('contact_id', 'CONTACT_ID', safe_int, None),
+    ('assigned_by_id', 'ASSIGNED_BY_ID', safe_int, None),
+    ('created_by_id', 'CREATED_BY_ID', safe_int, None),
+    ('closed', 'CLOSED', safe_bool),
+    ('begindate', 'BEGINDATE', safe_datetime),
+    ('closedate', 'CLOSEDATE', safe_datetime),
+    ('date_create', 'DATE_CREATE', safe_datetime),
+    ('date_modify', 'DATE_MODIFY', safe_datetime),
+    ('utm_source', 'UTM_SOURCE', None, None),
+    ('utm_medium', 'UTM_MEDIUM', None, None),
+    ('utm_campaign', 'UTM_CAMPAIGN', None, None),
+    ('utm_content', 'UTM_CONTENT', None, None),
+    ('utm_term', 'UTM_TERM', None, None),
+    ('source_id', 'SOURCE_ID', None, None),
+    ('source_description', 'SOURCE_DESCRIPTION', None, None),
+]
+
+COMPANY_FIELDS = [
+    ('id', 'ID', safe_int),
+    ('title', 'TITLE', None, None),
+    ('company_type', 'COMPANY_TYPE', None, None),
+    ('email', 'EMAIL', first_multifield),
+    ('phone', 'PHONE', first_multifield),
+    ('web', 'WEB', None, None),
+    ('address', 'ADDRESS', None, None),
+    ('date_create', 'DATE_CREATE', safe_datetime),
+    ('date_modify', 'DATE_MODIFY', safe_datetime),
+    ('assigned_by_id', 'ASSIGNED_BY_ID', safe_int, None),
+    ('created_by_id', 'CREATED_BY_ID', safe_int, None),
+]
+
+# full_name собирается из частей имени после построения строки
+CONTACT_FIELDS = [
+    ('id', 'ID', safe_int),
+    ('name', 'NAME', None, None),
+    ('last_name', 'LAST_NAME', None, None),
+    ('second_name', 'SECOND_NAME', None, None),
+    ('email', 'EMAIL', first_multifield),
+    ('phone', 'PHONE', first_multifield),
+    ('post', 'POST', None, None),
+    ('birthdate', 'BIRTHDATE', safe_datetime),
+    ('date_create', 'DATE_CREATE', safe_datetime),
+    ('date_modify', 'DATE_MODIFY', safe_datetime),
+    ('company_id', 'COMPANY_ID', safe_int),
+    ('assigned_by_id', 'ASSIGNED_BY_ID', safe_int),
+    ('created_by_id', 'CREATED_BY_ID', safe_int),
+    ('source_id', 'SOURCE_ID', None, None),
+    ('source_description', 'SOURCE_DESCRIPTION', None, None),
+]
+
+ACTIVITY_FIELDS = [
+    ('id', 'ID', safe_int),
+    ('owner_id', 'OWNER_ID', safe_int),
+    ('owner_type_id', 'OWNER_TYPE_ID', safe_int),
+    ('type_id', 'TYPE_ID', safe_int),
+    ('provider_id', 'PROVIDER_ID', None, None),
+    ('provider_type_id', 'PROVIDER_TYPE_ID', None, None),
+    ('subject', 'SUBJECT', None, None),
+    ('description', 'DESCRIPTION', None, None),
+    ('description_type', 'DESCRIPTION_TYPE', None, None),
+    ('direction', 'DIRECTION', safe_int),
+    ('priority', 'PRIORITY', safe_int),
+    ('status', 'STATUS', safe_int),
+    ('completed', 'COMPLETED', safe_datetime),
+    ('start_time', 'START_TIME', safe_datetime),
+    ('end_time', 'END_TIME', safe_datetime),
+    ('deadline', 'DEADLINE', safe_datetime),
+    ('created', 'CREATED', safe_datetime),
+    ('last_updated', 'LAST_UPDATED', safe_datetime),
+    ('responsible_id', 'RESPONSIBLE_ID', safe_int),
+    ('author_id', 'AUTHOR_ID', safe_int),
+]
+
+
+def compile_row_builder(name: str, fields: List[tuple]):
+    """
+    Сгенерировать функцию запись Bitrix24 -> строка таблицы из схемы полей.
+    Тело компилируется один раз: один dict-литерал с прямыми вызовами конвертеров,
+    без разбора схемы на каждую запись. Конвертеры привязаны аргументами по умолчанию -
+    внутри функции это локальные переменные, а не поиск в глобальном словаре
+    """
+    converters = {}
+    items = []
+    for column, key, convert, *empty in fields:
+        value = f'get({key!r})'
+        if convert is not None:
+            converters[convert.__name__] = convert
+            value = f'{convert.__name__}({value})'
+        if empty:
+            value = f'{value} or {empty[0]!r}'
+        items.append(f'        {column!r}: {value},')
+    args = ''.join(f', {conv}={conv}' for conv in converters)
+    source = f'def {name}(record{args}):\n    get = record.get\n    return {{\n' + '\n'.join(items) + '\n    }\n'
+    namespace = dict(converters)
+    exec(source, namespace)
+    return namespace[name]
+
+
+build_company_row = compile_row_builder('build_company_row', COMPANY_FIELDS)
+build_contact_row = compile_row_builder('build_contact_row', CONTACT_FIELDS)
+build_deal_row = compile_row_builder('build_deal_row', DEAL_FIELDS)
+build_activity_row = compile_row_builder('build_activity_row', ACTIVITY_FIELDS)
+
+# select[] для list-методов Bitrix24 - только поля, которые попадают в таблицы.
+# Применяется, если raw_data не сохраняется (иначе в raw_data нужна вся запись)
+COMPANY_SELECT = [key for _, key, *_ in COMPANY_FIELDS]
+CONTACT_SELECT = [key for _, key, *_ in CONTACT_FIELDS]
+DEAL_SELECT = [key for _, key, *_ in DEAL_FIELDS] + ['MODIFY_BY_ID']
+ACTIVITY_SELECT = [key for _, key, *_ in ACTIVITY_FIELDS] + ['EDITOR_ID', 'RESULT_VALUE']
+
+
+def json_loads(data: bytes) -> Any:
+    """Разобрать JSON-ответ (orjson, если установлен)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj: Any) -> bytes:
+    """Сериализовать объект в JSON (bytes) для тела HTTP-запроса"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+def row_hash(row: Dict) -> str:
+    """Короткий хэш содержимого строки: совпал с сохранённым - строка не изменилась"""
+    if orjson is not None:
+        data = orjson.dumps(row, option=orjson.OPT_SORT_KEYS)
+    else:
+        data = json.dumps(row, ensure_ascii=False, sort_keys=True).encode('utf-8')
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+def flatten_params(params: Dict, prefix: str = '') -> List[tuple]:
+    """Развернуть вложенные параметры в синтаксис Битрикс24: filter[>DATE_MODIFY]=..."""
+    items = []
+    for key, value in params.items():
+        name = f'{prefix}[{key}]' if prefix else str(key)
+        if isinstance(value, dict):
+            items.extend(flatten_params(value, name))
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                items.append((f'{name}[]', item))
+        else:
+            items.append((name, value))
+    return items
+
+
+def batch_section(value: Any) -> Dict[str, Any]:
+    """
+    Раздел ответа batch.json (result, result_error, result_next) как словарь.
+    PHP json_encode отдаёт массив с ключами 0..n-1 (в том числе пустой) JSON-списком
+    """
+    if isinstance(value, list):
+        return {str(i): item for i, item in enumerate(value)}
+    return value or {}
+
+
+def cap_high_water(high_water: Optional[str], started_at: str) -> Optional[str]:
+    """
+    Ограничить high-water mark началом обхода (started_at - UTC из log_sync_start) минус HIGH_WATER_SKEW.
+    Всё, что изменилось до начала, полный обход уже загрузил; изменённое позже - не ниже отметки.
+    Повторы на стыке безвредны: батчи по id, upsert
+    """
+    if not high_water:
+        return None
+    limit = datetime.fromisoformat(started_at).replace(tzinfo=timezone.utc) - HIGH_WATER_SKEW
+    try:
+        mark = datetime.fromisoformat(high_water)
+    except ValueError:
+        return limit.isoformat()
+    # Дата без часового пояса несравнима с UTC - надёжнее граница обхода
+    if mark.tzinfo is None or mark > limit:
+        return limit.isoformat()
+    return high_water
+
+
+def encode_params(params: Optional[Dict]) -> str:
+    """
+    Закодировать параметры запроса в query string.
+    HTTP-клиенты не умеют вложенные dict (filter={...} превращается в filter=<ключ>),
+    поэтому кодируем сами в формате filter[...]=...
+    """
+    return urlencode(flatten_params(params or {}))
+
+
+class TokenBucket:
+    """
+    Потокобезопасный token bucket под лимиты Bitrix24: rate запросов в секунду
+    в среднем и до capacity запросов подряд без ожидания.
+    Частота адаптивная (AIMD): при ответе "слишком много запросов" делится пополам,
+    после каждых 100 успешных запросов растёт на 0.1 - до исходной max_rate
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.max_rate = rate
+        self.min_rate = rate / 4
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.successes = 0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Взять токен; если бакет пуст - подождать, пока он пополнится"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # Токен резервируется сразу, ждём уже вне блокировки
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttled(self):
+        """Сервер ответил превышением лимита: вдвое снизить частоту и сбросить запас burst"""
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+            self.successes = 0
+
+    def succeeded(self):
+        """Успешный запрос: каждые 100 подряд повышают частоту на 0.1 req/s"""
+        with self.lock:
+            self.successes += 1
+            if self.successes >= 100 and self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + 0.1)
+                self.successes = 0
+
+
+class BatchWriter:
+    """
+    Фоновая запись батчей: extract_* отдаёт батч в очередь и сразу продолжает
+    грузить Bitrix24, пока предыдущий батч уходит в Supabase.
+    Очередь ограничена - при медленной базе extract_* ждёт (backpressure)
+    """
+
+    def __init__(self, write, maxsize: int = 4):
+        self.write = write
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, table: str, rows: List[Dict], done=None):
+        """Поставить батч в очередь; done() вызывается после успешной записи"""
+        if self.error is not None:
+            raise self.error
+        self.queue.put((table, rows, done))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            table, rows, done = item
+            # После первой ошибки остальные батчи пропускаем - extract_* завершится с ошибкой
+            if self.error is None:
+                try:
+                    self.write(table, rows)
+                    if done is not None:
+                        done()
+                except Exception as e:
+                    logger.error(f"  ❌ Error upserting {table} batch: {e}")
+                    logger.error(f"  Sample {table} data: {rows[0] if rows else 'empty'}")
+                    self.error = e
+            self.queue.task_done()
+
+    def flush(self):
+        """Дождаться записи всех батчей в очереди (и пробросить ошибку записи)"""
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """Остановить поток записи (оставшиеся в очереди батчи дописываются)"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+class PostgrestClient:
+    """
+    Прямой REST-клиент PostgREST (Supabase) для горячих путей загрузки.
+    Одно keep-alive соединение (HTTP/2, если доступен) вместо обвязки supabase-py
+    """
+
+    def __init__(self, url: str, key: str):
+        self.client = httpx.Client(
+            base_url=f"{url.rstrip('/')}/rest/v1",
+            http2=HTTP2_AVAILABLE,
+            timeout=60,
+            headers={
+                'apikey': key,
+                'Authorization': f'Bearer {key}',
+                'Content-Type': 'application/json',
+            }
+        )
+        self.compress = COMPRESS_UPLOADS
+
+    def post_json(self, path: str, payload: Any, params: Optional[Dict] = None,
+                  headers: Optional[Dict] = None) -> httpx.Response:
+        """POST JSON-тела; большие тела уходят сжатыми gzip (level 1 - почти без затрат CPU)"""
+        body = json_dumps(payload)
+        if self.compress and len(body) >= GZIP_MIN_BYTES:
+            response = self.client.post(
+                path,
+                content=gzip.compress(body, compresslevel=1),
+                params=params,
+                headers={**(headers or {}), 'Content-Encoding': 'gzip'}
+            )
+            # 415 или PGRST102 (невалидный JSON) - сервер не распаковывает тело,
+            # дальше шлём без сжатия
+            if response.status_code != 415 and 'PGRST102' not in response.text:
+                return response
+            logger.warning("⚠️  PostgREST does not accept gzip request bodies - sending uncompressed")
+            self.compress = False
+        return self.client.post(path, content=body, params=params, headers=headers)
+
+    def upsert(self, table: str, rows: List[Dict], ignore_duplicates: bool = False) -> int:
+        """
+        Upsert батча по первичному ключу id (ignore_duplicates - не трогать существующие строки).
+        Тело больше лимита сервера (413, крупный raw_data) - батч делится пополам
+        """
+        resolution = 'ignore-duplicates' if ignore_duplicates else 'merge-duplicates'
+        response = self.post_json(
+            f'/{table}',
+            rows,
+            params={'on_conflict': 'id'},
+            headers={'Prefer': f'resolution={resolution},return=minimal'}
+        )
+        if response.status_code == 413 and len(rows) > 1:
+            half = len(rows) // 2
+            logger.warning(f"⚠️  {table}: request body too large for {len(rows)} rows - splitting batch")
+            return (self.upsert(table, rows[:half], ignore_duplicates)
+                    + self.upsert(table, rows[half:], ignore_duplicates))
+        response.raise_for_status()
+        return len(rows)
+
+    def rpc(self, function: str, args: Dict) -> Any:
+        """Вызвать серверную функцию"""
+        response = self.post_json(f'/rpc/{function}', args)
+        response.raise_for_status()
+        return json_loads(response.content) if response.content else None
+
+    def insert(self, table: str, row: Dict):
+        """Вставить строку"""
+        response = self.client.post(f'/{table}', content=json_dumps(row), headers={'Prefer': 'return=minimal'})
+        response.raise_for_status()
+
+    def close(self):
+        self.client.close()
+
+
 class Bitrix24ETL:
     """ETL сервис для выгрузки данных из Bitrix24 в Supabase"""
 
     def __init__(self):
         self.bitrix_url = BITRIX_WEBHOOK
         self.supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-        self.rate_limit_delay = 0.6  # Увеличил до 0.6 после 429 ошибки (Too Many Requests)
+        self.rest = PostgrestClient(SUPABASE_URL, SUPABASE_KEY)  # Горячие пути: upsert батчей, sync_log
+        self.rate_limiter = TokenBucket(BITRIX_RATE, BITRIX_BURST)  # Общий для всех потоков пагинации
+
+        # Один потокобезопасный клиент к Bitrix24 на все потоки: по HTTP/2 параллельные
+        # страницы мультиплексируются в одном TLS-соединении, ответы приходят в gzip
+        self.http = httpx.Client(
+            timeout=30,
+            headers={'Accept-Encoding': 'gzip'},
+            transport=httpx.HTTPTransport(
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(max_connections=16, max_keepalive_connections=8),
+                retries=3  # Повтор при обрыве соединения
+            )
+        )
+        # Заглушки общие для параллельных extract_* (full sync). flush держит блокировку
+        # и на время вставки: иначе другой поток может вставить строку со ссылкой на
+        # заглушку, которой ещё нет в базе. Заглушки вставляются без перезаписи реальных строк
+        self.stub_lock = threading.Lock()
+        self.pg_lock = threading.Lock()  # Одно подключение Postgres - одна транзакция COPY за раз
+        self.log_pool = ThreadPoolExecutor(max_workers=1)  # Фоновая запись sync_log (строго по порядку)
         self.created_managers = set()  # Кэш уже созданных менеджеров
         self.pending_managers = []  # Батч для вставки менеджеров
         self.created_companies = set()  # Кэш уже созданных компаний
         self.pending_companies = []  # Батч для вставки компаний
         self.created_contacts = set()  # Кэш уже созданных контактов
         self.pending_contacts = []  # Батч для вставки контактов
+        self.changed_deal_ids = set()  # Сделки, затронутые синхронизацией (для пересчёта паттернов)
+        self.row_hashes = {}  # table -> {id: row_hash} строк в базе (нет таблицы - хэши не используются)
+        self.pg_conn = None  # Прямое подключение к Postgres для COPY (только full sync)
+        self.rpc_upsert = dict(RPC_UPSERT)  # Отключаем RPC для таблицы, если функции нет в базе
+        self.rpc_stubs = True  # Отключаем RPC insert_stubs, если функции нет в базе
+        self.sync_high_water = True  # Нет колонки sync_log.high_water - пишем лог без неё
+        # Одна граница HOURS_BACK на весь запуск: все сущности фильтруются по одному моменту
+        self.cutoff_time = (datetime.utcnow() - timedelta(hours=HOURS_BACK)).isoformat()
+
+        if SYNC_MODE == 'full' and SUPABASE_DB_URL:
+            if psycopg is None:
+                logger.warning("⚠️  SUPABASE_DB_URL is set but psycopg is not installed - using REST upsert")
+            else:
+                try:
+                    conn = psycopg.connect(SUPABASE_DB_URL)
+                    # Каждый батч коммитится отдельно (заглушки через PostgREST должны сразу
+                    # видеть строки), поэтому не ждём сброса WAL на диск на каждый COMMIT:
+                    # при сбое базы теряются только последние батчи, повторный full sync их перезапишет
+                    conn.execute("SET synchronous_commit TO off")
+                    conn.commit()
+                    self.pg_conn = conn
+                    logger.info("🚀 Using direct Postgres COPY for bulk load")
+                except Exception as e:
+                    logger.warning(f"⚠️  Could not connect to Postgres, using REST upsert: {e}")
 
         # Загрузить существующие ID из базы если пропускаем полную выгрузку
         self.load_existing_ids()
 
     # ==================== УТИЛИТЫ ====================
 
+    def load_table_rows(self, table: str, columns: str) -> List[Dict]:
+        """Загрузить колонки всех строк таблицы (постранично, чтобы получить ВСЕ)"""
+        rows = []
+        range_start = 0
+        range_size = 1000
+        while True:
+            response = self.supabase.table(table).select(columns).range(range_start, range_start + range_size - 1).execute()
+            if not response.data:
+                break
+            rows.extend(response.data)
+            if len(response.data) < range_size:
+                break
+            range_start += range_size
+        return rows
+
     def load_existing_ids(self):
-        """Загрузить все существующие ID из Supabase чтобы не создавать дубликаты"""
+        """
+        Загрузить все существующие ID (и хэши строк) из Supabase чтобы не создавать дубликаты.
+        Одним вызовом RPC existing_ids (см. supabase_schema.sql): скалярный JSONB не режется
+        лимитом max-rows, поэтому не нужен обход таблиц по 1000 строк
+        """
+        logger.info("📋 Loading existing IDs from Supabase...")
         try:
-            # Загрузить ID компаний (постранично, чтобы получить ВСЕ)
-            logger.info("📋 Loading existing company IDs from Supabase...")
-            all_companies = []
-            range_start = 0
-            range_size = 1000
-            while True:
-                response = self.supabase.table('companies').select('id').range(range_start, range_start + range_size - 1).execute()
-                if not response.data:
-                    break
-                all_companies.extend(response.data)
-                if len(response.data) < range_size:
-                    break
-                range_start += range_size
-
-            if all_companies:
-                self.created_companies = {row['id'] for row in all_companies}
-                logger.info(f"  ✅ Loaded {len(self.created_companies)} existing company IDs")
-
-            # Загрузить ID контактов (постранично)
-            logger.info("📋 Loading existing contact IDs from Supabase...")
-            all_contacts = []
-            range_start = 0
-            while True:
-                response = self.supabase.table('contacts').select('id').range(range_start, range_start + range_size - 1).execute()
-                if not response.data:
-                    break
-                all_contacts.extend(response.data)
-                if len(response.data) < range_size:
-                    break
-                range_start += range_size
-
-            if all_contacts:
-                self.created_contacts = {row['id'] for row in all_contacts}
-                logger.info(f"  ✅ Loaded {len(self.created_contacts)} existing contact IDs")
+            existing = self.rest.rpc('existing_ids', {})
+        except Exception as e:
+            logger.warning(f"⚠️  RPC existing_ids is not available, loading IDs page by page: {e}")
+            self.load_existing_ids_paged()
+            return
+
+        for table, created in (('companies', self.created_companies), ('contacts', self.created_contacts)):
+            pairs = existing[table]
+            created.update(row_id for row_id, _ in pairs)
+            self.row_hashes[table] = {row_id: hash_value for row_id, hash_value in pairs if hash_value}
+            logger.info(f"  ✅ {table}: loaded {len(pairs)} existing IDs")
+        self.created_managers.update(existing['managers'])
+        logger.info(f"  ✅ Loaded {len(existing['managers'])} existing manager IDs")
+
+    def load_existing_ids_paged(self):
+        """Загрузить существующие ID постранично (схема без функции existing_ids)"""
+        try:
+            for table, label, created in (('companies', 'company', self.created_companies),
+                                          ('contacts', 'contact', self.created_contacts)):
+                logger.info(f"📋 Loading existing {label} IDs from Supabase...")
+                try:
+                    rows = self.load_table_rows(table, 'id,row_hash')
+                    self.row_hashes[table] = {row['id']: row['row_hash'] for row in rows if row['row_hash']}
+                except Exception as e:
+                    # Схема без row_hash - грузим все строки как раньше
+                    logger.warning(f"⚠️  {table}.row_hash is not available, unchanged rows will be re-sent: {e}")
+                    rows = self.load_table_rows(table, 'id')
+
+                created.update(row['id'] for row in rows)
+                if rows:
+                    logger.info(f"  ✅ Loaded {len(rows)} existing {label} IDs")
 
             # Загрузить ID менеджеров (обычно их мало, хватит одного запроса)
             logger.info("📋 Loading existing manager IDs from Supabase...")
@@ -108,6 +675,76 @@ class Bitrix24ETL:
             logger.warning(f"⚠️  Could not load existing IDs from Supabase: {e}")
             logger.warning("  Continuing without cache - may create some duplicate stubs")
 
+    def close(self):
+        """Закрыть HTTP-клиенты и прямое подключение к Postgres"""
+        self.http.close()
+        self.log_pool.shutdown(wait=True)  # Сначала дописать sync_log, потом закрыть клиент
+        self.rest.close()
+        if self.pg_conn is not None:
+            self.pg_conn.close()
+            self.pg_conn = None
+
+    def upsert_rows(self, table: str, rows: List[Dict]) -> int:
+        """Upsert батча строк: COPY в full sync (если есть подключение), иначе PostgREST"""
+        if not rows:
+            return 0
+        if self.pg_conn is not None:
+            return self.copy_upsert(table, rows)
+
+        rpc_name = self.rpc_upsert.get(table)
+        if rpc_name:
+            try:
+                return self.rest.rpc(rpc_name, {'payload': rows}) or 0
+            except Exception as e:
+                logger.warning(f"⚠️  RPC {rpc_name} failed, falling back to table upsert: {e}")
+                self.rpc_upsert.pop(table, None)
+
+        return self.rest.upsert(table, rows)
+
+    def copy_upsert(self, table: str, rows: List[Dict]) -> int:
+        """COPY батча во временную таблицу и перенос в целевую через INSERT ... ON CONFLICT"""
+        columns = list(rows[0].keys())
+        staging = f'{table}_staging'
+        col_list = sql.SQL(', ').join(map(sql.Identifier, columns))
+        updates = sql.SQL(', ').join(
+            sql.SQL('{col} = EXCLUDED.{col}').format(col=sql.Identifier(col))
+            for col in columns if col != 'id'
+        )
+
+        with self.pg_lock:
+            try:
+                with self.pg_conn.cursor() as cur:
+                    cur.execute(sql.SQL(
+                        'CREATE TEMP TABLE IF NOT EXISTS {staging} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS'
+                    ).format(staging=sql.Identifier(staging), table=sql.Identifier(table)))
+
+                    with cur.copy(sql.SQL('COPY {staging} ({cols}) FROM STDIN').format(
+                            staging=sql.Identifier(staging), cols=col_list)) as copy:
+                        for row in rows:
+                            copy.write_row([
+                                Jsonb(value) if isinstance(value, (dict, list)) else value
+                                for value in (row.get(col) for col in columns)
+                            ])
+
+                    cur.execute(sql.SQL(
+                        'INSERT INTO {table} ({cols}) SELECT {cols} FROM {staging} '
+                        'ON CONFLICT (id) DO UPDATE SET {updates}'
+                    ).format(table=sql.Identifier(table), cols=col_list,
+                             staging=sql.Identifier(staging), updates=updates))
+                self.pg_conn.commit()
+                return len(rows)
+            except Exception:
+                self.pg_conn.rollback()
+                raise
+
+    def mark_created(self, created: set, ids):
+        """
+        Отметить реальные записи как уже существующие в базе - только после их upsert,
+        чтобы параллельный поток до этого момента создавал для них заглушки
+        """
+        with self.stub_lock:
+            created.update(ids)
+
     def ensure_manager_exists(self, user_id: int):
         """Добавить менеджера в батч (создание отложено до flush)"""
         if not user_id or user_id in self.created_managers:
@@ -123,24 +760,11 @@ class Bitrix24ETL:
             'personal_mobile': None,
             'raw_data': {'ID': user_id, 'note': 'Auto-created on-the-fly'}
         }
-        self.pending_managers.append(manager_data)
-        self.created_managers.add(user_id)
-
-    def flush_managers(self):
-        """Вставить всех накопленных менеджеров в базу"""
-        if not self.pending_managers:
-            return
-
-        try:
-            # Батчами по 50
-            for i in range(0, len(self.pending_managers), 50):
-                batch = self.pending_managers[i:i+50]
-                self.supabase.table('managers').upsert(batch).execute()
-            logger.info(f"  ✅ Flushed {len(self.pending_managers)} managers to DB")
-            self.pending_managers = []
-        except Exception as e:
-            logger.error(f"  ❌ Error flushing managers: {e}")
-            self.pending_managers = []
+        with self.stub_lock:
+            if user_id in self.created_managers:
+                return
+            self.pending_managers.append(manager_data)
+            self.created_managers.add(user_id)
 
     def ensure_company_exists(self, company_id: int):
         """Добавить компанию-заглушку в батч (для отсутствующих компаний)"""
@@ -161,24 +785,11 @@ class Bitrix24ETL:
             'created_by_id': None,
             'raw_data': {'ID': company_id, 'note': 'Auto-created stub for missing company'}
         }
-        self.pending_companies.append(company_data)
-        self.created_companies.add(company_id)
-
-    def flush_companies(self):
-        """Вставить всех накопленных компаний-заглушек в базу"""
-        if not self.pending_companies:
-            return
-
-        try:
-            # Батчами по 50
-            for i in range(0, len(self.pending_companies), 50):
-                batch = self.pending_companies[i:i+50]
-                self.supabase.table('companies').upsert(batch).execute()
-            logger.info(f"  ✅ Flushed {len(self.pending_companies)} company stubs to DB")
-            self.pending_companies = []
-        except Exception as e:
-            logger.error(f"  ❌ Error flushing companies: {e}")
-            self.pending_companies = []
+        with self.stub_lock:
+            if company_id in self.created_companies:
+                return
+            self.pending_companies.append(company_data)
+            self.created_companies.add(company_id)
 
     def ensure_contact_exists(self, contact_id: int):
         """Добавить контакт-заглушку в батч (создание отложено до flush)"""
@@ -202,211 +813,363 @@ class Bitrix24ETL:
             'source_description': None,
             'raw_data': {'ID': contact_id, 'note': 'Auto-created stub for missing contact'}
         }
-        self.pending_contacts.append(contact_data)
-        self.created_contacts.add(contact_id)
+        with self.stub_lock:
+            if contact_id in self.created_contacts:
+                return
+            self.pending_contacts.append(contact_data)
+            self.created_contacts.add(contact_id)
 
-    def flush_contacts(self):
-        """Вставить всех накопленных контактов-заглушек в базу"""
-        if not self.pending_contacts:
-            return
+    def flush_stubs(self, strict: bool = True):
+        """
+        Вставить все накопленные заглушки (менеджеры, компании, контакты) в базу.
+        Все три таблицы уходят одним RPC-вызовом insert_stubs на UPSERT_BATCH строк
+        каждой - один запрос вместо трёх перед каждым батчем записей.
+        При ошибке невставленные заглушки возвращаются в очередь (их id уже в created_*),
+        strict - пробросить ошибку, чтобы батч со ссылками на них не ушёл в базу
+        """
+        with self.stub_lock:
+            pending = {
+                'managers': self.pending_managers,
+                'companies': self.pending_companies,
+                'contacts': self.pending_contacts,
+            }
+            pending = {table: rows for table, rows in pending.items() if rows}
+            if not pending:
+                return
+            self.pending_managers, self.pending_companies, self.pending_contacts = [], [], []
 
-        try:
-            # Батчами по 50
-            for i in range(0, len(self.pending_contacts), 50):
-                batch = self.pending_contacts[i:i+50]
-                self.supabase.table('contacts').upsert(batch).execute()
-            logger.info(f"  ✅ Flushed {len(self.pending_contacts)} contact stubs to DB")
-            self.pending_contacts = []
-        except Exception as e:
-            logger.error(f"  ❌ Error flushing contacts: {e}")
-            self.pending_contacts = []
+            i = 0
+            try:
+                longest = max(len(rows) for rows in pending.values())
+                for i in range(0, longest, UPSERT_BATCH):
+                    chunk = {table: rows[i:i+UPSERT_BATCH] for table, rows in pending.items()}
+                    self.insert_stubs({table: rows for table, rows in chunk.items() if rows})
+                flushed = ', '.join(f"{len(rows)} {table}" for table, rows in pending.items())
+                logger.info(f"  ✅ Flushed stubs to DB: {flushed}")
+            except Exception as e:
+                logger.error(f"  ❌ Error flushing stubs (kept for retry): {e}")
+                # Уже вставленные куски (до i) не повторяем
+                self.pending_managers = pending.get('managers', [])[i:]
+                self.pending_companies = pending.get('companies', [])[i:]
+                self.pending_contacts = pending.get('contacts', [])[i:]
+                if strict:
+                    raise
+
+    def insert_stubs(self, stubs: Dict[str, List[Dict]]):
+        """Один батч заглушек: RPC insert_stubs, без функции в базе - по таблицам через PostgREST"""
+        if self.rpc_stubs:
+            try:
+                self.rest.rpc('insert_stubs', {'payload': stubs})
+                return
+            except Exception as e:
+                logger.warning(f"⚠️  RPC insert_stubs failed, falling back to table upserts: {e}")
+                self.rpc_stubs = False
+
+        # Порядок словаря (менеджеры, компании, контакты) - по внешним ключам
+        for table, rows in stubs.items():
+            self.rest.upsert(table, rows, ignore_duplicates=True)
+
+    def fetch_page(self, url: str, query: str, start: int) -> Dict:
+        """
+        Загрузить одну страницу списка Bitrix24 GET-запросом.
+        query - заранее закодированные параметры (см. encode_params), меняется только start
+        """
+        page_url = f"{url}?{query}&start={start}" if query else f"{url}?start={start}"
+        return self.send_bitrix('GET', page_url)
+
+    def send_bitrix(self, http_method: str, url: str, body: Optional[str] = None) -> Dict:
+        """
+        Запрос к Bitrix24 (с ожиданием при 429 Too Many Requests и повтором при 502/503/504).
+        Превышение лимита снижает частоту запросов rate_limiter.
+        body - закодированная форма для POST (batch.json)
+        """
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'} if body is not None else None
+        for attempt in range(5):
+            self.rate_limiter.acquire()
+            response = self.http.request(http_method, url, content=body, headers=headers)
+
+            # Обработка 429 Too Many Requests
+            if response.status_code == 429:
+                self.rate_limiter.throttled()
+                # Retry-After (в секундах), если сервер его прислал, иначе ждём 60 секунд
+                retry_after = response.headers.get('Retry-After', '')
+                wait_time = int(retry_after) if retry_after.isdigit() else 60
+                logger.warning(f"⚠️  429 Too Many Requests! Rate lowered to {self.rate_limiter.rate:.2f} req/s, "
+                               f"waiting {wait_time}s before retry...")
+                time.sleep(wait_time)
+                continue  # Повторяем тот же запрос
+
+            if response.status_code in (502, 503, 504) and attempt < 4:
+                # Превышение лимита Bitrix24 отдаёт как 503 QUERY_LIMIT_EXCEEDED
+                if b'QUERY_LIMIT_EXCEEDED' in response.content:
+                    self.rate_limiter.throttled()
+                time.sleep(0.3 * 2 ** attempt)
+                continue
+
+            break
+
+        response.raise_for_status()
+        self.rate_limiter.succeeded()
+        return json_loads(response.content)
 
     @staticmethod
-    def safe_int(value: Any, default: Optional[int] = None) -> Optional[int]:
-        """Безопасное преобразование в int"""
-        if value is None or value == '' or value == 'null':
-            return default
-        try:
-            return int(float(value))
-        except (ValueError, TypeError):
-            return default
-    
-    @staticmethod
-    def safe_float(value: Any, default: Optional[float] = None) -> Optional[float]:
-        """Безопасное преобразование в float"""
-        if value is None or value == '' or value == 'null':
-            return default
-        try:
-            return float(value)
-        except (ValueError, TypeError):
-            return default
-    
-    @staticmethod
-    def safe_datetime(value: Any) -> Optional[str]:
-        """Безопасное преобразование даты в ISO формат"""
-        if not value or value == '' or value == 'null':
-            return None
-        try:
-            if isinstance(value, str):
-                value = value.replace('Z', '+00:00')
-                dt = datetime.fromisoformat(value)
-                return dt.isoformat()
-            return None
-        except (ValueError, TypeError):
-            return None
-    
-    @staticmethod
-    def safe_bool(value: Any) -> bool:
-        """Безопасное преобразование в bool"""
-        if value is None or value == '':
-            return False
-        if isinstance(value, bool):
-            return value
-        if isinstance(value, str):
-            return value.upper() in ('Y', 'YES', 'TRUE', '1')
-        return bool(value)
-    
+    def normalize_results(results: Any) -> List[Dict]:
+        """Привести result ответа Bitrix24 к списку записей"""
+        # Если result - это dict (для некоторых методов типа crm.category.list),
+        # извлекаем массив из вложенного ключа или оборачиваем в массив
+        if isinstance(results, dict):
+            # Для crm.category.list результат может быть {'categories': [...]}
+            # или {'0': {...}, '1': {...}} - в этом случае берем values
+            if 'categories' in results:
+                results = results['categories']
+            else:
+                # Если dict с числовыми ключами, берем values
+                results = list(results.values())
+
+        # Если результат всё ещё dict после обработки, оборачиваем в список
+        if isinstance(results, dict):
+            results = [results]
+
+        return results
+
     def bitrix_request(self, method: str, params: Optional[Dict] = None) -> List[Dict]:
-        """Выполнить запрос к Bitrix24 API с пагинацией"""
-        all_results = []
-        start = 0
-        iterations = 0
-        max_iterations = 1000  # Защита от бесконечного цикла
-        last_count = 0
-        stuck_counter = 0  # Счётчик "застреваний" на одном месте
+        """Выполнить запрос к Bitrix24 API с пагинацией и вернуть все записи списком"""
+        return list(self.iter_bitrix(method, params))
 
+    def iter_bitrix(self, method: str, params: Optional[Dict] = None,
+                    scan: Optional[Dict] = None) -> Iterator[Dict]:
+        """
+        Выполнить запрос к Bitrix24 API с пагинацией, отдавая записи по мере загрузки страниц.
+        Первая страница сообщает total, следующие грузятся параллельно по BATCH_PAGES страниц
+        за запрос batch.json - не больше PAGE_WINDOW запросов впереди потребителя,
+        в памяти не копится вся выборка.
+        scan - словарь состояния: scan['complete'] = True, только если выборка прочитана
+        целиком (не оборвалась на ошибке запроса или лимите 50000 записей)
+        """
         if params is None:
             params = {}
+        if scan is None:
+            scan = {}
+        scan['complete'] = False
+
+        url = f"{self.bitrix_url}{method}.json"
+        # Параметры кодируются один раз на весь запрос, а не на каждую страницу
+        query = encode_params(params)
 
         # Логируем начало запроса
         logger.info(f"  🔄 Starting Bitrix24 request: {method}")
 
-        while True:
-            iterations += 1
-            if iterations > max_iterations:
-                logger.error(f"  ❌ Max iterations ({max_iterations}) reached! Breaking loop.")
-                break
+        try:
+            data = self.fetch_page(url, query, 0)
+        except Exception as e:
+            logger.error(f"❌ Error in Bitrix24 request {method}: {e}")
+            return
 
-            # Проверка на зависание (если количество не растёт)
-            if len(all_results) == last_count:
-                stuck_counter += 1
-                if stuck_counter > 3:
-                    logger.error(f"  ❌ Stuck at {len(all_results)} records for 3 iterations! Breaking.")
-                    break
-            else:
-                stuck_counter = 0
-                last_count = len(all_results)
-            request_params = {**params, 'start': start}
-            url = f"{self.bitrix_url}{method}.json"
+        if not data.get('result'):
+            logger.info(f"  ✅ {method}: completed, total 0 records")
+            scan['complete'] = True
+            return
+
+        first_page = self.normalize_results(data['result'])
+        loaded = len(first_page)
+        total = data.get('total', 0)
+        yield from first_page
+
+        # Проверка условий выхода: одна страница или total неизвестен
+        if loaded < 50 or total <= loaded:
+            logger.info(f"  ✅ {method}: completed, total {loaded} records")
+            scan['complete'] = True
+            return
+
+        # EMERGENCY: не больше 50000 записей (защита от некорректного total)
+        truncated = False
+        if total > 50000:
+            logger.warning(f"  ⚠️  {method}: total={total}, limiting to 50000 records")
+            total = 50000
+            truncated = True
+
+        # Все остальные offset'ы известны заранее - грузим их параллельно скользящим окном,
+        # группами по BATCH_PAGES страниц
+        offsets = list(range(50, total, 50))
+        groups = iter([offsets[i:i + BATCH_PAGES] for i in range(0, len(offsets), BATCH_PAGES)])
+        logger.info(f"  ⏳ {method}: {total} records, fetching {len(offsets)} more pages in parallel...")
+
+        with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as executor:
+            pending = deque()
+
+            def submit_next():
+                starts = next(groups, None)
+                if starts is not None:
+                    pending.append((starts, executor.submit(self.fetch_pages, method, query, starts)))
+
+            for _ in range(PAGE_WINDOW):
+                submit_next()
 
             try:
-                time.sleep(self.rate_limit_delay)
-                response = requests.get(url, params=request_params, timeout=30)
-
-                # Обработка 429 Too Many Requests
-                if response.status_code == 429:
-                    wait_time = 60  # Ждём 60 секунд
-                    logger.warning(f"⚠️  429 Too Many Requests! Waiting {wait_time}s before retry...")
-                    time.sleep(wait_time)
-                    continue  # Повторяем тот же запрос
-
-                response.raise_for_status()
-                data = response.json()
-
-                if 'result' not in data:
-                    break
-
-                results = data['result']
-                if not results:
-                    break
-
-                # Если result - это dict (для некоторых методов типа crm.category.list),
-                # извлекаем массив из вложенного ключа или оборачиваем в массив
-                if isinstance(results, dict):
-                    # Для crm.category.list результат может быть {'categories': [...]}
-                    # или {'0': {...}, '1': {...}} - в этом случае берем values
-                    if 'categories' in results:
-                        results = results['categories']
-                    else:
-                        # Если dict с числовыми ключами, берем values
-                        results = list(results.values())
-
-                # Если результат всё ещё dict после обработки, оборачиваем в список
-                if isinstance(results, dict):
-                    results = [results]
-
-                all_results.extend(results)
-
-                # Логируем прогресс каждые 500 записей
-                if len(all_results) % 500 == 0:
-                    total = data.get('total', 0)
-                    logger.info(f"  ⏳ {method}: loaded {len(all_results)}/{total} records...")
-
-                total = data.get('total', 0)
-
-                # Проверка условий выхода из цикла
-                if len(results) < 50:
-                    logger.info(f"  🛑 Got less than 50 results ({len(results)}), stopping pagination")
-                    break
-
-                if total > 0 and len(all_results) >= total:
-                    logger.info(f"  🛑 Loaded all {total} records, stopping pagination")
-                    break
-
-                # КРИТИЧЕСКАЯ проверка: если загрузили уже много но total=0 или некорректен → BREAK
-                if len(all_results) >= 2000 and (total == 0 or total < len(all_results)):
-                    logger.error(f"  ❌ Loaded {len(all_results)} but total={total} (invalid)! Breaking to prevent infinite loop.")
-                    break
-
-                # EMERGENCY: Если загрузили >= 50000 ЛЮБЫХ записей → FORCE BREAK!
-                if len(all_results) >= 50000:
-                    logger.warning(f"  ⚠️  EMERGENCY BREAK at {len(all_results)} records! Returning what we have to avoid infinite loop.")
-                    break
-
-                start += 50
-
-            except requests.exceptions.HTTPError as e:
-                if '429' in str(e):
-                    # Дополнительная обработка 429 если не поймали выше
-                    logger.warning(f"⚠️  429 in exception! Waiting 60s...")
-                    time.sleep(60)
-                    continue
-                logger.error(f"❌ HTTP Error in Bitrix24 request {method}: {e}")
-                break
-            except Exception as e:
-                logger.error(f"❌ Error in Bitrix24 request {method}: {e}")
-                break
+                # Страницы отдаются по порядку; на первой ошибке или пустой странице
+                # останавливаемся, как и раньше при последовательной загрузке
+                finished = False
+                while pending and not finished:
+                    starts, future = pending.popleft()
+                    try:
+                        pages = future.result()
+                    except Exception as e:
+                        logger.error(f"❌ Error in Bitrix24 request {method} (start={starts[0]}): {e}")
+                        truncated = True
+                        break
+                    submit_next()
+
+                    for results in pages:
+                        if not results:
+                            finished = True
+                            break
+                        loaded += len(results)
+                        yield from results
+
+                        # Логируем прогресс каждые 500 записей
+                        if loaded % 500 == 0:
+                            logger.info(f"  ⏳ {method}: loaded {loaded}/{total} records...")
+            finally:
+                # Досрочный выход (ошибка, пустая страница, потребитель прекратил чтение)
+                for _, future in pending:
+                    future.cancel()
+
+        logger.info(f"  ✅ {method}: completed, total {loaded} records")
+        scan['complete'] = not truncated
+
+    def fetch_batch(self, cmd: Dict[str, str]) -> Dict:
+        """
+        Один запрос batch.json: cmd - {ключ: 'метод?закодированные параметры'}.
+        POST формой: подкоманды, закодированные второй раз, в URL GET-запроса не помещаются (414)
+        """
+        data = self.send_bitrix('POST', f"{self.bitrix_url}batch.json", encode_params({'halt': 0, 'cmd': cmd}))
+        return data.get('result') or {}
+
+    def fetch_pages(self, method: str, query: str, starts: List[int]) -> List[List[Dict]]:
+        """Загрузить страницы списка с offset'ами starts одним запросом batch.json (по порядку starts)"""
+        if len(starts) == 1:
+            page = self.fetch_page(f"{self.bitrix_url}{method}.json", query, starts[0])
+            return [self.normalize_results(page.get('result') or [])]
+
+        prefix = f"{method}?{query}&" if query else f"{method}?"
+        batch_result = self.fetch_batch({str(start): f"{prefix}start={start}" for start in starts})
+        errors = batch_result.get('result_error')
+        if errors:
+            raise RuntimeError(f"batch {method}: {errors}")
+        sub_results = batch_section(batch_result.get('result'))
+        return [self.normalize_results(sub_results.get(str(start)) or []) for start in starts]
+
+    def bitrix_batch(self, commands: Dict[str, tuple]) -> Dict[str, Any]:
+        """
+        Выполнить несколько методов Bitrix24 через batch.json (до BATCH_LIMIT подкоманд
+        за запрос). commands: {ключ: (метод, параметры)}, результат: {ключ: result}.
+        Подкоманды с ошибкой в результат не попадают; если у списка есть следующие
+        страницы (result_next) - он догружается целиком через bitrix_request
+        """
+        keys = list(commands)
+        results = {}
+        for i in range(0, len(keys), BATCH_LIMIT):
+            chunk = keys[i:i + BATCH_LIMIT]
+            batch_result = self.fetch_batch({
+                key: f"{commands[key][0]}?{encode_params(commands[key][1])}" for key in chunk
+            })
 
-        logger.info(f"  ✅ {method}: completed, total {len(all_results)} records")
-        return all_results
-    
-    def log_sync_start(self, entity_type: str) -> int:
-        """Записать начало синхронизации"""
-        try:
-            result = self.supabase.table('sync_log').insert({
-                'sync_type': SYNC_MODE,
-                'entity_type': entity_type,
-                'status': 'running',
-                'started_at': datetime.utcnow().isoformat(),
-                'records_processed': 0
-            }).execute()
-            return result.data[0]['id']
-        except Exception as e:
-            logger.error(f"❌ Error logging sync start: {e}")
-            return 0
-    
-    def log_sync_end(self, sync_id: int, status: str, records: int, error_msg: Optional[str] = None):
-        """Записать окончание синхронизации"""
+            sub_results = batch_section(batch_result.get('result'))
+            sub_errors = batch_section(batch_result.get('result_error'))
+            sub_next = batch_section(batch_result.get('result_next'))
+            for key in chunk:
+                if key in sub_errors:
+                    logger.warning(f"  ⚠️  batch {commands[key][0]} ({key}) failed: {sub_errors[key]}")
+                elif key in sub_next:
+                    results[key] = self.bitrix_request(*commands[key])
+                else:
+                    results[key] = sub_results.get(key) or []
+        return results
+
+    def log_sync_start(self, entity_type: str) -> Dict:
+        """
+        Начать запись sync_log. В базу пока ничего не пишется: строка целиком
+        (с итоговым статусом) вставляется одним запросом в log_sync_end
+        """
+        return {
+            'sync_type': SYNC_MODE,
+            'entity_type': entity_type,
+            'started_at': datetime.utcnow().isoformat(),
+        }
+
+    def log_sync_end(self, sync_row: Dict, status: str, records: int, error_msg: Optional[str] = None,
+                     high_water: Optional[str] = None):
+        """Записать синхронизацию в фоне (high_water - максимальная дата изменения среди записей)"""
+        row = {
+            **sync_row,
+            'status': status,
+            'finished_at': datetime.utcnow().isoformat(),
+            'records_processed': records,
+            'error_message': error_msg
+        }
+        if high_water:
+            row['high_water'] = high_water
+        self.log_pool.submit(self.write_sync_log, row)
+
+    def log_scan_end(self, sync_row: Dict, records: int, high_water: Optional[str], complete: bool):
+        """
+        Записать итог обхода сущности. high_water сохраняется только за полный обход:
+        выборка идёт по ID, а не по дате, и записи с непрочитанных страниц оказались бы
+        ниже отметки - следующие incremental их бы уже не загрузили.
+        По той же причине отметка не позже начала обхода: запись с малым ID, изменённая
+        после того, как обход её прошёл, старше записи с большим ID, изменённой позже
+        """
+        if complete:
+            self.log_sync_end(sync_row, 'completed', records,
+                              high_water=cap_high_water(high_water, sync_row['started_at']))
+        else:
+            logger.warning(f"  ⚠️  {sync_row['entity_type']}: Bitrix24 scan incomplete, high-water mark not advanced")
+            self.log_sync_end(sync_row, 'failed', records, 'Bitrix24 scan incomplete')
+
+    def write_sync_log(self, row: Dict):
+        if not self.sync_high_water:
+            row.pop('high_water', None)
         try:
-            self.supabase.table('sync_log').update({
-                'status': status,
-                'finished_at': datetime.utcnow().isoformat(),
-                'records_processed': records,
-                'error_message': error_msg
-            }).eq('id', sync_id).execute()
+            self.rest.insert('sync_log', row)
         except Exception as e:
-            logger.error(f"❌ Error logging sync end: {e}")
-    
+            response = getattr(e, 'response', None)
+            if 'high_water' in row and response is not None and 'high_water' in response.text:
+                # Схема без sync_log.high_water - пишем лог без неё, incremental идёт по HOURS_BACK
+                logger.warning(f"⚠️  sync_log.high_water is not available, logging without it: {e}")
+                self.sync_high_water = False
+                self.write_sync_log(row)
+                return
+            logger.error(f"❌ Error logging sync: {e}")
+
+    def wait_sync_log(self):
+        """Дождаться записи всех отправленных в фон строк sync_log"""
+        self.log_pool.submit(lambda: None).result()
+
+    def incremental_filter(self, entity_type: str, date_field: str) -> Dict:
+        """
+        Фильтр инкрементальной выгрузки: всё, что изменилось с high-water mark
+        последней успешной синхронизации сущности. Если её нет - за HOURS_BACK часов
+        """
+        if USE_HIGH_WATER:
+            try:
+                response = self.supabase.table('sync_log')\
+                    .select('high_water')\
+                    .eq('entity_type', entity_type)\
+                    .eq('status', 'completed')\
+                    .not_.is_('high_water', 'null')\
+                    .order('high_water', desc=True)\
+                    .limit(1)\
+                    .execute()
+                if response.data:
+                    high_water = response.data[0]['high_water']
+                    logger.info(f"  📌 {entity_type}: loading changes since {high_water}")
+                    # >= : записи, изменённые в ту же секунду после прошлой выгрузки, не теряются
+                    return {f'>={date_field}': high_water}
+            except Exception as e:
+                logger.warning(f"⚠️  Could not read high-water mark for {entity_type}: {e}")
+
+        return {f'>{date_field}': self.cutoff_time}
+
     # ==================== ИЗВЛЕЧЕНИЕ ДАННЫХ ====================
     
     
@@ -422,6 +1185,7 @@ class Bitrix24ETL:
             categories = self.bitrix_request('crm.category.list', {'entityTypeId': 2})  # 2 = DEAL
 
             if categories:
+                category_batch = []
                 for cat in categories:
                     # Если cat - это строка или не dict, пропускаем
                     if not isinstance(cat, dict):
@@ -429,31 +1193,37 @@ class Bitrix24ETL:
                         continue
 
                     cat_data = {
-                        'id': self.safe_int(cat.get('id')),
+                        'id': safe_int(cat.get('id')),
                         'name': cat.get('name') or f"Category {cat.get('id')}",
-                        'sort': self.safe_int(cat.get('sort')) or 500,
+                        'sort': safe_int(cat.get('sort')) or 500,
                         'is_default': cat.get('isDefault') == 'Y'
                     }
-                    self.supabase.table('deal_categories').upsert(cat_data).execute()
+                    category_batch.append(cat_data)
+
+                # Воронок немного - один запрос на все
+                self.upsert_rows('deal_categories', category_batch)
                 logger.info(f"  ✅ Loaded {len(categories)} deal categories")
 
             # 2. Стадии сделок (stages)
             logger.info("  📋 Loading deal stages...")
             all_stages = []
-            # Получаем стадии для каждой воронки
+            # Стадии всех воронок - одним запросом batch.json, а не запросом на воронку
             if categories:
-                for cat in categories:
-                    cat_id = self.safe_int(cat.get('id'))
-                    stages = self.bitrix_request('crm.status.list', {
-                        'filter[ENTITY_ID]': f'DEAL_STAGE_{cat_id}'
-                    })
-                    for stage in stages:
+                # Нечисловые ключи подкоманд: иначе ответ для воронок 0..n-1 приходит JSON-списком
+                category_ids = {f'cat_{cat_id}': cat_id for cat_id in (safe_int(cat.get('id')) for cat in categories)}
+                stages_by_category = self.bitrix_batch({
+                    key: ('crm.status.list', {'filter': {'ENTITY_ID': f'DEAL_STAGE_{cat_id}'}})
+                    for key, cat_id in category_ids.items()
+                })
+                for key, stages in stages_by_category.items():
+                    cat_id = category_ids[key]
+                    for stage in self.normalize_results(stages):
                         stage_data = {
                             'id': stage['STATUS_ID'],
                             'name': stage.get('NAME') or stage['STATUS_ID'],
                             'category_id': cat_id,
                             'status_id': stage['STATUS_ID'],
-                            'sort': self.safe_int(stage.get('SORT')) or 500,
+                            'sort': safe_int(stage.get('SORT')) or 500,
                             'color': stage.get('COLOR'),
                             'semantics': stage.get('SEMANTICS')
                         }
@@ -461,9 +1231,8 @@ class Bitrix24ETL:
 
             if all_stages:
                 # Вставляем батчами
-                for i in range(0, len(all_stages), 50):
-                    batch = all_stages[i:i+50]
-                    self.supabase.table('deal_stages').upsert(batch).execute()
+                for i in range(0, len(all_stages), UPSERT_BATCH):
+                    self.upsert_rows('deal_stages', all_stages[i:i+UPSERT_BATCH])
                 logger.info(f"  ✅ Loaded {len(all_stages)} deal stages")
 
             # 3. Статусы лидов
@@ -477,15 +1246,14 @@ class Bitrix24ETL:
                     status_data = {
                         'id': status['STATUS_ID'],
                         'name': status.get('NAME') or status['STATUS_ID'],
-                        'sort': self.safe_int(status.get('SORT')) or 500,
+                        'sort': safe_int(status.get('SORT')) or 500,
                         'color': status.get('COLOR'),
                         'semantics': status.get('SEMANTICS')
                     }
                     status_batch.append(status_data)
 
-                for i in range(0, len(status_batch), 50):
-                    batch = status_batch[i:i+50]
-                    self.supabase.table('lead_statuses').upsert(batch).execute()
+                for i in range(0, len(status_batch), UPSERT_BATCH):
+                    self.upsert_rows('lead_statuses', status_batch[i:i+UPSERT_BATCH])
                 logger.info(f"  ✅ Loaded {len(status_batch)} lead statuses")
 
             logger.info("  ✅ Dictionaries loaded successfully")
@@ -499,466 +1267,419 @@ class Bitrix24ETL:
     def extract_companies(self) -> int:
         """Извлечь компании"""
         logger.info("📥 Extracting companies...")
-        sync_id = self.log_sync_start('companies')
+        sync_row = self.log_sync_start('companies')
 
         processed = 0
+        high_water = None  # Максимальная дата изменения среди загруженных записей
+        writer = BatchWriter(self.upsert_rows)
+        known_hashes = self.row_hashes.get('companies')
+        unchanged = 0
         try:
             params = {}
 
             if SYNC_MODE == 'incremental':
-                cutoff_time = (datetime.utcnow() - timedelta(hours=HOURS_BACK)).isoformat()
-                params['filter'] = {'>DATE_MODIFY': cutoff_time}
+                params['filter'] = self.incremental_filter('companies', 'DATE_MODIFY')
 
-            companies = self.bitrix_request('crm.company.list', params)
+            if not STORE_RAW:
+                params['select'] = COMPANY_SELECT
 
-            batch = []
+            scan = {}
+            companies = self.iter_bitrix('crm.company.list', params, scan)
 
-            for company in companies:
-                company_id = self.safe_int(company['ID'])
+            # Батч по id: повторы записи (сдвиг страниц Bitrix24) схлопываются в последнюю версию,
+            # иначе Postgres падает с "ON CONFLICT DO UPDATE command cannot affect row a second time"
+            batch = {}
 
-                # Отметить что эта компания уже загружена (реальная, не заглушка)
-                self.created_companies.add(company_id)
+            # Методы, вызываемые на каждую запись, - в локальные переменные
+            ensure_manager = self.ensure_manager_exists
+            for company in companies:
+                company_data = build_company_row(company)
 
                 # Создать менеджеров если их нет в базе
-                assigned_by_id = self.safe_int(company.get('ASSIGNED_BY_ID'))
-                created_by_id = self.safe_int(company.get('CREATED_BY_ID'))
-                if assigned_by_id:
-                    self.ensure_manager_exists(assigned_by_id)
-                if created_by_id:
-                    self.ensure_manager_exists(created_by_id)
-
-                # EMAIL и PHONE приходят как массивы
-                email_value = None
-                if company.get('EMAIL') and isinstance(company['EMAIL'], list) and len(company['EMAIL']) > 0:
-                    email_value = company['EMAIL'][0].get('VALUE')
-
-                phone_value = None
-                if company.get('PHONE') and isinstance(company['PHONE'], list) and len(company['PHONE']) > 0:
-                    phone_value = company['PHONE'][0].get('VALUE')
-
-                company_data = {
-                    'id': company_id,
-                    'title': company.get('TITLE') or None,
-                    'company_type': company.get('COMPANY_TYPE') or None,
-                    'email': email_value,
-                    'phone': phone_value,
-                    'web': company.get('WEB') or None,
-                    'address': company.get('ADDRESS') or None,
-                    'date_create': self.safe_datetime(company.get('DATE_CREATE')),
-                    'date_modify': self.safe_datetime(company.get('DATE_MODIFY')),
-                    'assigned_by_id': assigned_by_id if assigned_by_id else None,
-                    'created_by_id': created_by_id if created_by_id else None,
-                    'raw_data': company
-                }
-
-                batch.append(company_data)
+                if company_data['assigned_by_id']:
+                    ensure_manager(company_data['assigned_by_id'])
+                if company_data['created_by_id']:
+                    ensure_manager(company_data['created_by_id'])
+
+                if STORE_RAW:
+                    company_data['raw_data'] = company
+
+                if known_hashes is None:
+                    batch[company_data['id']] = company_data
+                else:
+                    # Тот же row_hash, что в базе - строка не изменилась, повторно не отправляем
+                    company_data['row_hash'] = row_hash(company_data)
+                    if known_hashes.get(company_data['id']) != company_data['row_hash']:
+                        batch[company_data['id']] = company_data
+                    else:
+                        unchanged += 1
+                # Bitrix24 отдаёт даты в часовом поясе портала - ISO-строки сравнимы напрямую
+                if company_data['date_modify'] and (high_water is None or company_data['date_modify'] > high_water):
+                    high_water = company_data['date_modify']
                 processed += 1
 
-                if len(batch) >= 50:
-                    self.supabase.table('companies').upsert(batch).execute()
+                if len(batch) >= UPSERT_BATCH:
+                    # Флашим заглушки ПЕРЕД вставкой батча
+                    self.flush_stubs()
+                    writer.put('companies', list(batch.values()),
+                               partial(self.mark_created, self.created_companies, list(batch)))
                     logger.info(f"  📊 Companies extracted: {processed}")
-                    batch = []
+                    batch = {}
 
             # Вставить остаток
             if batch:
-                self.supabase.table('companies').upsert(batch).execute()
+                self.flush_stubs()
+                writer.put('companies', list(batch.values()),
+                           partial(self.mark_created, self.created_companies, list(batch)))
 
             # Сохранить всех накопленных менеджеров
-            self.flush_managers()
+            self.flush_stubs()
+            writer.flush()
 
-            logger.info(f"  ✅ Companies extracted: {processed}")
-            self.log_sync_end(sync_id, 'completed', processed)
+            logger.info(f"  ✅ Companies extracted: {processed} (unchanged, skipped: {unchanged})")
+            self.log_scan_end(sync_row, processed, high_water, scan['complete'])
             return processed
 
         except Exception as e:
             logger.error(f"  ❌ Error extracting companies: {e}")
-            self.flush_managers()  # Сохранить менеджеров даже при ошибке
-            self.log_sync_end(sync_id, 'failed', processed)
+            self.flush_stubs(strict=False)  # Сохранить заглушки даже при ошибке
+            self.log_sync_end(sync_row, 'failed', processed)
             return processed
+        finally:
+            writer.close()
 
     def extract_contacts(self) -> int:
         """Извлечь контакты"""
         logger.info("📥 Extracting contacts...")
-        sync_id = self.log_sync_start('contacts')
+        sync_row = self.log_sync_start('contacts')
         
         processed = 0
+        high_water = None  # Максимальная дата изменения среди загруженных записей
+        writer = BatchWriter(self.upsert_rows)
+        known_hashes = self.row_hashes.get('contacts')
+        unchanged = 0
         try:
             params = {}
             
             if SYNC_MODE == 'incremental':
-                cutoff_time = (datetime.utcnow() - timedelta(hours=HOURS_BACK)).isoformat()
-                params['filter'] = {'>DATE_MODIFY': cutoff_time}
+                params['filter'] = self.incremental_filter('contacts', 'DATE_MODIFY')
             
-            contacts = self.bitrix_request('crm.contact.list', params)
+            if not STORE_RAW:
+                params['select'] = CONTACT_SELECT
+
+            scan = {}
+            contacts = self.iter_bitrix('crm.contact.list', params, scan)
             
-            batch = []
+            batch = {}
             
+            ensure_manager = self.ensure_manager_exists
+            ensure_company = self.ensure_company_exists
             for contact in contacts:
+                contact_data = build_contact_row(contact)
+
                 # Создать компанию-заглушку если её нет в базе
-                company_id = self.safe_int(contact.get('COMPANY_ID'))
-                if company_id:
-                    self.ensure_company_exists(company_id)
+                if contact_data['company_id']:
+                    ensure_company(contact_data['company_id'])
 
                 # Создать менеджеров если их нет
-                assigned_by_id = self.safe_int(contact.get('ASSIGNED_BY_ID'))
-                created_by_id = self.safe_int(contact.get('CREATED_BY_ID'))
-                if assigned_by_id:
-                    self.ensure_manager_exists(assigned_by_id)
-                if created_by_id:
-                    self.ensure_manager_exists(created_by_id)
-
-                # EMAIL и PHONE приходят как массивы
-                email_value = None
-                if contact.get('EMAIL') and isinstance(contact['EMAIL'], list) and len(contact['EMAIL']) > 0:
-                    email_value = contact['EMAIL'][0].get('VALUE')
-
-                phone_value = None
-                if contact.get('PHONE') and isinstance(contact['PHONE'], list) and len(contact['PHONE']) > 0:
-                    phone_value = contact['PHONE'][0].get('VALUE')
+                if contact_data['assigned_by_id']:
+                    ensure_manager(contact_data['assigned_by_id'])
+                if contact_data['created_by_id']:
+                    ensure_manager(contact_data['created_by_id'])
 
                 # Собираем полное имя
-                name_parts = [
-                    contact.get('NAME'),
-                    contact.get('SECOND_NAME'),
-                    contact.get('LAST_NAME')
-                ]
-                full_name = ' '.join(filter(None, name_parts)) or None
-
-                contact_data = {
-                    'id': self.safe_int(contact['ID']),
-                    'name': contact.get('NAME') or None,
-                    'last_name': contact.get('LAST_NAME') or None,
-                    'second_name': contact.get('SECOND_NAME') or None,
-                    'full_name': full_name,
-                    'email': email_value,
-                    'phone': phone_value,
-                    'post': contact.get('POST') or None,
-                    'birthdate': self.safe_datetime(contact.get('BIRTHDATE')),
-                    'date_create': self.safe_datetime(contact.get('DATE_CREATE')),
-                    'date_modify': self.safe_datetime(contact.get('DATE_MODIFY')),
-                    'company_id': company_id,
-                    'assigned_by_id': self.safe_int(contact.get('ASSIGNED_BY_ID')),
-                    'created_by_id': self.safe_int(contact.get('CREATED_BY_ID')),
-                    'source_id': contact.get('SOURCE_ID') or None,
-                    'source_description': contact.get('SOURCE_DESCRIPTION') or None,
-                    'raw_data': contact
-                }
+                contact_data['full_name'] = ' '.join([
+                    part for part in (contact_data['name'], contact_data['second_name'], contact_data['last_name'])
+                    if part
+                ]) or None
+
+                if STORE_RAW:
+                    contact_data['raw_data'] = contact
                 
-                batch.append(contact_data)
+                if known_hashes is None:
+                    batch[contact_data['id']] = contact_data
+                else:
+                    # Тот же row_hash, что в базе - строка не изменилась, повторно не отправляем
+                    contact_data['row_hash'] = row_hash(contact_data)
+                    if known_hashes.get(contact_data['id']) != contact_data['row_hash']:
+                        batch[contact_data['id']] = contact_data
+                    else:
+                        unchanged += 1
+                if contact_data['date_modify'] and (high_water is None or contact_data['date_modify'] > high_water):
+                    high_water = contact_data['date_modify']
                 processed += 1
 
-                if len(batch) >= 50:
+                if len(batch) >= UPSERT_BATCH:
                     # Флашим заглушки ПЕРЕД вставкой батча
-                    self.flush_companies()
-                    self.flush_managers()
-                    self.supabase.table('contacts').upsert(batch).execute()
+                    self.flush_stubs()
+                    writer.put('contacts', list(batch.values()),
+                               partial(self.mark_created, self.created_contacts, list(batch)))
                     logger.info(f"  📊 Contacts extracted: {processed}")
-                    batch = []
+                    batch = {}
 
             if batch:
                 # Флашим заглушки ПЕРЕД вставкой остатка
-                self.flush_companies()
-                self.flush_managers()
-                self.supabase.table('contacts').upsert(batch).execute()
+                self.flush_stubs()
+                writer.put('contacts', list(batch.values()),
+                           partial(self.mark_created, self.created_contacts, list(batch)))
 
             # Сохранить накопленные заглушки
-            self.flush_companies()
-            self.flush_managers()
+            self.flush_stubs()
+            writer.flush()
 
-            logger.info(f"  ✅ Contacts extracted: {processed}")
-            self.log_sync_end(sync_id, 'completed', processed)
+            logger.info(f"  ✅ Contacts extracted: {processed} (unchanged, skipped: {unchanged})")
+            self.log_scan_end(sync_row, processed, high_water, scan['complete'])
             return processed
 
         except Exception as e:
             logger.error(f"  ❌ Error extracting contacts: {e}")
-            self.flush_companies()  # Сохранить заглушки даже при ошибке
-            self.flush_managers()
-            self.log_sync_end(sync_id, 'failed', processed, str(e))
+            self.flush_stubs(strict=False)  # Сохранить заглушки даже при ошибке
+            self.log_sync_end(sync_row, 'failed', processed, str(e))
             return processed
+        finally:
+            writer.close()
     
     def extract_deals(self) -> int:
         """Извлечь сделки (streaming - вставка во время загрузки)"""
         logger.info("📥 Extracting deals...")
-        sync_id = self.log_sync_start('deals')
+        sync_row = self.log_sync_start('deals')
 
         processed = 0
-        batch = []
+        high_water = None  # Максимальная дата изменения среди загруженных записей
+        batch = {}
+        writer = BatchWriter(self.upsert_rows)
 
         try:
             params = {}
 
             if SYNC_MODE == 'incremental':
-                cutoff_time = (datetime.utcnow() - timedelta(hours=HOURS_BACK)).isoformat()
-                params['filter'] = {'>DATE_MODIFY': cutoff_time}
+                params['filter'] = self.incremental_filter('deals', 'DATE_MODIFY')
+
+            if not STORE_RAW:
+                params['select'] = DEAL_SELECT
 
             logger.info("  🔄 Starting streaming deals extraction...")
 
-            # STREAMING: грузим и вставляем постранично, БЕЗ накопления в память
-            start = 0
+            # STREAMING: грузим и вставляем постранично, БЕЗ накопления в память.
+            # Следующая страница грузится в фоне, пока текущая обрабатывается,
+            # а готовые батчи upsert'ятся в своём потоке (BatchWriter).
+            # Пагинация по ключу: первая страница с start=0 (узнаём total), дальше
+            # start=-1 + фильтр >ID - Битрикс не считает COUNT(*) и не делает OFFSET
+            url = f"{self.bitrix_url}crm.deal.list.json"
+            params['order'] = {'ID': 'ASC'}
+            base_filter = params.get('filter', {})
+            total = 0
             page = 0
-
-            while True:
-                page += 1
-                request_params = {**params, 'start': start}
-                url = f"{self.bitrix_url}crm.deal.list.json"
-
-                time.sleep(self.rate_limit_delay)
-                response = requests.get(url, params=request_params, timeout=30)
-                response.raise_for_status()
-                data = response.json()
-
-                if 'result' not in data or not data['result']:
-                    break
-
-                deals_page = data['result']
-                logger.info(f"  📄 Page {page}: processing {len(deals_page)} deals...")
-
-                for deal in deals_page:
-                    # Создать менеджеров если их нет в базе
-                    self.ensure_manager_exists(self.safe_int(deal.get('ASSIGNED_BY_ID')))
-                    self.ensure_manager_exists(self.safe_int(deal.get('CREATED_BY_ID')))
-                    self.ensure_manager_exists(self.safe_int(deal.get('MODIFY_BY_ID')))
-
-                    # Создать компании/контакты если их нет в базе
-                    company_id = self.safe_int(deal.get('COMPANY_ID'))
-                    contact_id = self.safe_int(deal.get('CONTACT_ID'))
-                    if company_id:
-                        self.ensure_company_exists(company_id)
-                    if contact_id:
-                        self.ensure_contact_exists(contact_id)
-
-                    deal_data = {
-                        'id': self.safe_int(deal['ID']),
-                        'title': deal.get('TITLE') or None,
-                        'type_id': deal.get('TYPE_ID') or None,
-                        'category_id': self.safe_int(deal.get('CATEGORY_ID')),
-                        'stage_id': deal.get('STAGE_ID') or None,
-                        'stage_semantic_id': deal.get('STAGE_SEMANTIC_ID') or None,
-                        'opportunity': self.safe_float(deal.get('OPPORTUNITY')),
-                        'currency_id': deal.get('CURRENCY_ID') or 'RUB',
-                        'tax_value': self.safe_float(deal.get('TAX_VALUE')),
-                        'company_id': company_id if company_id else None,
-                        'contact_id': contact_id if contact_id else None,
-                        'assigned_by_id': self.safe_int(deal.get('ASSIGNED_BY_ID')) or None,
-                        'created_by_id': self.safe_int(deal.get('CREATED_BY_ID')) or None,
-                        'closed': self.safe_bool(deal.get('CLOSED')),
-                        'begindate': self.safe_datetime(deal.get('BEGINDATE')),
-                        'closedate': self.safe_datetime(deal.get('CLOSEDATE')),
-                        'date_create': self.safe_datetime(deal.get('DATE_CREATE')),
-                        'date_modify': self.safe_datetime(deal.get('DATE_MODIFY')),
-                        'utm_source': deal.get('UTM_SOURCE') or None,
-                        'utm_medium': deal.get('UTM_MEDIUM') or None,
-                        'utm_campaign': deal.get('UTM_CAMPAIGN') or None,
-                        'utm_content': deal.get('UTM_CONTENT') or None,
-                        'utm_term': deal.get('UTM_TERM') or None,
-                        'source_id': deal.get('SOURCE_ID') or None,
-                        'source_description': deal.get('SOURCE_DESCRIPTION') or None,
-                        'raw_data': deal
-                    }
-
-                    batch.append(deal_data)
-                    processed += 1
-
-                # После обработки всех deals на странице - проверяем батч
-                if len(batch) >= 50:
-                    # Флашим заглушки ПЕРЕД вставкой батча
-                    self.flush_companies()
-                    self.flush_contacts()
-                    self.flush_managers()
-                    try:
-                        response = self.supabase.table('deals').upsert(batch).execute()
-                        logger.info(f"  📊 Deals extracted: {processed}, inserted: {len(response.data) if response.data else 0}")
-                    except Exception as e:
-                        logger.error(f"  ❌ Error upserting deals batch: {e}")
-                        logger.error(f"  Sample deal data: {batch[0] if batch else 'empty'}")
-                        raise
-                    batch = []
-
-                # Проверка условий выхода
-                if len(deals_page) < 50:
-                    logger.info(f"  🛑 Got less than 50 results ({len(deals_page)}), stopping pagination")
-                    break
-
-                total = data.get('total', 0)
-                if total > 0 and processed >= total:
-                    logger.info(f"  🛑 Loaded all {total} records, stopping pagination")
-                    break
-
-                # EMERGENCY: защита от бесконечного цикла
-                if processed >= 50000:
-                    logger.warning(f"  ⚠️  EMERGENCY BREAK at {processed} records!")
-                    break
-
-                start += 50
+            scan = {'complete': True}  # False - обход оборвался на лимите 50000 записей
+
+            ensure_manager = self.ensure_manager_exists
+            ensure_company = self.ensure_company_exists
+            ensure_contact = self.ensure_contact_exists
+
+            with ThreadPoolExecutor(max_workers=1) as prefetcher:
+                next_page = prefetcher.submit(self.fetch_page, url, encode_params(params), 0)
+
+                while True:
+                    page += 1
+                    data = next_page.result()
+                    next_page = None
+
+                    if 'result' not in data or not data['result']:
+                        break
+
+                    deals_page = data['result']
+                    if page == 1:
+                        total = data.get('total', 0)
+
+                    # Запрашиваем следующую страницу заранее, только если она точно понадобится
+                    loaded = processed + len(deals_page)
+                    if len(deals_page) >= 50 and (total == 0 or loaded < total) and loaded < 50000:
+                        last_id = safe_int(deals_page[-1].get('ID'))
+                        next_query = encode_params({**params, 'filter': {**base_filter, '>ID': last_id}})
+                        next_page = prefetcher.submit(self.fetch_page, url, next_query, -1)
+
+                    logger.info(f"  📄 Page {page}: processing {len(deals_page)} deals...")
+
+                    for deal in deals_page:
+                        deal_data = build_deal_row(deal)
+
+                        # Создать менеджеров если их нет в базе
+                        ensure_manager(deal_data['assigned_by_id'])
+                        ensure_manager(deal_data['created_by_id'])
+                        ensure_manager(safe_int(deal.get('MODIFY_BY_ID')))
+
+                        # Создать компании/контакты если их нет в базе
+                        if deal_data['company_id']:
+                            ensure_company(deal_data['company_id'])
+                        if deal_data['contact_id']:
+                            ensure_contact(deal_data['contact_id'])
+
+                        if STORE_RAW:
+                            deal_data['raw_data'] = deal
+
+                        batch[deal_data['id']] = deal_data
+                        if deal_data['date_modify'] and (high_water is None or deal_data['date_modify'] > high_water):
+                            high_water = deal_data['date_modify']
+                        self.changed_deal_ids.add(deal_data['id'])
+                        processed += 1
+
+                    # После обработки всех deals на странице - проверяем батч
+                    if len(batch) >= UPSERT_BATCH:
+                        # Флашим заглушки ПЕРЕД вставкой батча
+                        self.flush_stubs()
+                        writer.put('deals', list(batch.values()))
+                        logger.info(f"  📊 Deals extracted: {processed}")
+                        batch = {}
+
+                    # Проверка условий выхода
+                    if len(deals_page) < 50:
+                        logger.info(f"  🛑 Got less than 50 results ({len(deals_page)}), stopping pagination")
+                        break
+
+                    if total > 0 and processed >= total:
+                        logger.info(f"  🛑 Loaded all {total} records, stopping pagination")
+                        break
+
+                    # EMERGENCY: защита от бесконечного цикла
+                    if processed >= 50000:
+                        logger.warning(f"  ⚠️  EMERGENCY BREAK at {processed} records!")
+                        scan['complete'] = False
+                        break
+
+                    if next_page is None:
+                        break
 
             if batch:
                 # Флашим заглушки ПЕРЕД вставкой остатка
-                self.flush_companies()
-                self.flush_contacts()
-                self.flush_managers()
-                try:
-                    response = self.supabase.table('deals').upsert(batch).execute()
-                    logger.info(f"  ✅ Final batch inserted: {len(response.data) if response.data else 0} deals")
-                except Exception as e:
-                    logger.error(f"  ❌ Error upserting final deals batch: {e}")
-                    logger.error(f"  Sample deal data: {batch[0] if batch else 'empty'}")
-                    raise
+                self.flush_stubs()
+                writer.put('deals', list(batch.values()))
 
             # Сохранить накопленные заглушки
-            self.flush_companies()
-            self.flush_contacts()
-            self.flush_managers()
+            self.flush_stubs()
+            writer.flush()
 
             logger.info(f"  ✅ Deals extracted: {processed}")
-            self.log_sync_end(sync_id, 'completed', processed)
+            self.log_scan_end(sync_row, processed, high_water, scan['complete'])
             return processed
 
         except Exception as e:
             logger.error(f"  ❌ Error extracting deals: {e}")
-            self.flush_managers()  # Сохранить менеджеров даже при ошибке
-            self.log_sync_end(sync_id, 'failed', processed, str(e))
+            self.flush_stubs(strict=False)  # Сохранить заглушки даже при ошибке
+            self.log_sync_end(sync_row, 'failed', processed, str(e))
             return processed
+        finally:
+            writer.close()
     
     def extract_activities(self) -> int:
         """Извлечь активности (звонки, встречи, email)"""
         logger.info("📥 Extracting activities...")
-        sync_id = self.log_sync_start('activities')
+        sync_row = self.log_sync_start('activities')
         
         processed = 0
+        high_water = None  # Максимальная дата изменения среди загруженных записей
+        writer = BatchWriter(self.upsert_rows)
         try:
             params = {}
             
             if SYNC_MODE == 'incremental':
-                cutoff_time = (datetime.utcnow() - timedelta(hours=HOURS_BACK)).isoformat()
-                params['filter'] = {'>LAST_UPDATED': cutoff_time}
+                params['filter'] = self.incremental_filter('activities', 'LAST_UPDATED')
             
-            activities = self.bitrix_request('crm.activity.list', params)
+            if not STORE_RAW:
+                params['select'] = ACTIVITY_SELECT
+
+            scan = {}
+            activities = self.iter_bitrix('crm.activity.list', params, scan)
             
-            batch = []
+            batch = {}
             
+            ensure_manager = self.ensure_manager_exists
             for activity in activities:
+                activity_data = build_activity_row(activity)
+
                 # Создать менеджеров если их нет в базе
-                self.ensure_manager_exists(self.safe_int(activity.get('RESPONSIBLE_ID')))
-                self.ensure_manager_exists(self.safe_int(activity.get('AUTHOR_ID')))
-                self.ensure_manager_exists(self.safe_int(activity.get('EDITOR_ID')))
+                ensure_manager(activity_data['responsible_id'])
+                ensure_manager(activity_data['author_id'])
+                ensure_manager(safe_int(activity.get('EDITOR_ID')))
 
                 # Длительность звонка
-                call_duration = None
-                if activity.get('PROVIDER_ID') == 'VOXIMPLANT':
-                    call_duration = self.safe_int(activity.get('RESULT_VALUE'))
-
-                activity_data = {
-                    'id': self.safe_int(activity['ID']),
-                    'owner_id': self.safe_int(activity.get('OWNER_ID')),
-                    'owner_type_id': self.safe_int(activity.get('OWNER_TYPE_ID')),
-                    'type_id': self.safe_int(activity.get('TYPE_ID')),
-                    'provider_id': activity.get('PROVIDER_ID') or None,
-                    'provider_type_id': activity.get('PROVIDER_TYPE_ID') or None,
-                    'subject': activity.get('SUBJECT') or None,
-                    'description': activity.get('DESCRIPTION') or None,
-                    'description_type': activity.get('DESCRIPTION_TYPE') or None,
-                    'direction': self.safe_int(activity.get('DIRECTION')),
-                    'priority': self.safe_int(activity.get('PRIORITY')),
-                    'status': self.safe_int(activity.get('STATUS')),
-                    'completed': self.safe_datetime(activity.get('COMPLETED')),
-                    'start_time': self.safe_datetime(activity.get('START_TIME')),
-                    'end_time': self.safe_datetime(activity.get('END_TIME')),
-                    'deadline': self.safe_datetime(activity.get('DEADLINE')),
-                    'created': self.safe_datetime(activity.get('CREATED')),
-                    'last_updated': self.safe_datetime(activity.get('LAST_UPDATED')),
-                    'responsible_id': self.safe_int(activity.get('RESPONSIBLE_ID')),
-                    'author_id': self.safe_int(activity.get('AUTHOR_ID')),
-                    'call_duration': call_duration,
-                    'raw_data': activity
-                }
+                activity_data['call_duration'] = (
+                    safe_int(activity.get('RESULT_VALUE')) if activity.get('PROVIDER_ID') == 'VOXIMPLANT' else None
+                )
+                if STORE_RAW:
+                    activity_data['raw_data'] = activity
                 
-                batch.append(activity_data)
+                batch[activity_data['id']] = activity_data
+                if activity_data['last_updated'] and (high_water is None or activity_data['last_updated'] > high_water):
+                    high_water = activity_data['last_updated']
+                # Активность сделки (OWNER_TYPE_ID = 2) меняет её паттерны
+                if activity_data['owner_type_id'] == 2 and activity_data['owner_id']:
+                    self.changed_deal_ids.add(activity_data['owner_id'])
                 processed += 1
                 
-                if len(batch) >= 50:
-                    self.supabase.table('activities').upsert(batch).execute()
+                if len(batch) >= UPSERT_BATCH:
+                    # Флашим заглушки ПЕРЕД вставкой батча
+                    self.flush_stubs()
+                    writer.put('activities', list(batch.values()))
                     logger.info(f"  📊 Activities extracted: {processed}")
-                    batch = []
+                    batch = {}
             
             if batch:
-                self.supabase.table('activities').upsert(batch).execute()
+                self.flush_stubs()
+                writer.put('activities', list(batch.values()))
 
             # Сохранить всех накопленных менеджеров
-            self.flush_managers()
+            self.flush_stubs()
+            writer.flush()
 
             logger.info(f"  ✅ Activities extracted: {processed}")
-            self.log_sync_end(sync_id, 'completed', processed)
+            self.log_scan_end(sync_row, processed, high_water, scan['complete'])
             return processed
 
         except Exception as e:
             logger.error(f"  ❌ Error extracting activities: {e}")
-            self.flush_managers()  # Сохранить менеджеров даже при ошибке
-            self.log_sync_end(sync_id, 'failed', processed, str(e))
+            self.flush_stubs(strict=False)  # Сохранить заглушки даже при ошибке
+            self.log_sync_end(sync_row, 'failed', processed, str(e))
             return processed
+        finally:
+            writer.close()
     
     # ==================== РАСЧЁТ ПАТТЕРНОВ ====================
     
-    def calculate_patterns(self):
-        """Рассчитать аналитические паттерны для сделок"""
+    def calculate_patterns(self, deal_ids: Optional[set] = None):
+        """
+        Рассчитать аналитические паттерны для сделок.
+        deal_ids - только изменённые сделки (incremental); None - пересчёт всех сделок.
+        Считает сама база - одна функция refresh_deal_patterns (см. supabase_schema.sql)
+        вместо запроса активностей и upsert на каждую сделку
+        """
         logger.info("🔄 Calculating deal patterns...")
-        
+
+        if deal_ids is not None and not deal_ids:
+            logger.info("  ℹ️ No deals to calculate patterns")
+            return
+
         try:
-            # Прямой SQL через postgrest
-            # Вместо RPC используем прямые UPDATE/INSERT
-            
-            # Получаем список всех сделок
-            deals_response = self.supabase.table('deals').select('id').execute()
-            deal_ids = [d['id'] for d in deals_response.data]
-            
-            if not deal_ids:
-                logger.info("  ℹ️ No deals to calculate patterns")
-                return
-            
-            # Для каждой сделки считаем паттерны
-            for deal_id in deal_ids:
-                # Получаем активности сделки
-                activities = self.supabase.table('activities')\
-                    .select('*')\
-                    .eq('owner_id', deal_id)\
-                    .eq('owner_type_id', 2)\
-                    .execute()
-                
-                if not activities.data:
-                    continue
-                
-                # Считаем метрики
-                touches_count = len(activities.data)
-                calls_count = len([a for a in activities.data if a.get('type_id') == 2])
-                emails_count = len([a for a in activities.data if a.get('type_id') == 4])
-                meetings_count = len([a for a in activities.data if a.get('type_id') == 1])
-                
-                call_durations = [a.get('call_duration') for a in activities.data if a.get('call_duration')]
-                avg_call_duration = sum(call_durations) / len(call_durations) if call_durations else None
-                
-                created_dates = [a.get('created') for a in activities.data if a.get('created')]
-                first_activity_date = min(created_dates) if created_dates else None
-                last_activity_date = max(created_dates) if created_dates else None
-                
-                # Сохраняем паттерн
-                pattern_data = {
-                    'deal_id': deal_id,
-                    'touches_count': touches_count,
-                    'calls_count': calls_count,
-                    'emails_count': emails_count,
-                    'meetings_count': meetings_count,
-                    'avg_call_duration': avg_call_duration,
-                    'first_activity_date': first_activity_date,
-                    'last_activity_date': last_activity_date
-                }
-                
-                self.supabase.table('deal_patterns').upsert(pattern_data).execute()
-            
-            logger.info(f"  ✅ Patterns calculated for {len(deal_ids)} deals")
-            
+            args = {'p_deal_ids': sorted(deal_ids)} if deal_ids is not None else {}
+            updated = self.rest.rpc('refresh_deal_patterns', args) or 0
+            logger.info(f"  ✅ Patterns calculated for {updated} deals")
+
         except Exception as e:
             logger.error(f"  ❌ Error calculating patterns: {e}")
-    
+
     # ==================== ОСНОВНЫЕ МЕТОДЫ ====================
+
+    def run_extractors(self, extractors: Dict[str, Any]) -> Dict[str, int]:
+        """
+        Запустить extract_* параллельно, вернуть число записей по каждой сущности.
+        Каждая сущность большую часть времени ждёт Bitrix24 или Supabase,
+        общий лимит запросов к Bitrix24 соблюдает TokenBucket
+        """
+        counts = {}
+        with ThreadPoolExecutor(max_workers=len(extractors)) as executor:
+            futures = {executor.submit(extract): name for name, extract in extractors.items()}
+            for future in as_completed(futures):
+                counts[futures[future]] = future.result()
+        return counts
     
     def full_sync(self):
         """
@@ -975,25 +1696,29 @@ class Bitrix24ETL:
         self.extract_dictionaries()
 
         # Managers создаются автоматически в процессе загрузки
-        companies_count = self.extract_companies()
-        contacts_count = self.extract_contacts()
-        deals_count = self.extract_deals()
-        activities_count = self.extract_activities()
+        counts = self.run_extractors({
+            'companies': self.extract_companies,
+            'contacts': self.extract_contacts,
+            'deals': self.extract_deals,
+            'activities': self.extract_activities,
+        })
         managers_count = len(self.created_managers)
 
-        # ОТКЛЮЧЕНО: calculate_patterns() тормозит при большом количестве сделок
-        # self.calculate_patterns()
+        # Паттерны - только после загрузки всех сделок и активностей
+        # (один пакетный SQL-пересчёт на стороне базы)
+        self.calculate_patterns()
         
+        self.wait_sync_log()
         duration = time.time() - start_time
         
         logger.info("=" * 80)
         logger.info("✅ FULL SYNC COMPLETED")
         logger.info(f"   Duration: {duration:.2f}s")
         logger.info(f"   Managers: {managers_count}")
-        logger.info(f"   Companies: {companies_count}")
-        logger.info(f"   Contacts: {contacts_count}")
-        logger.info(f"   Deals: {deals_count}")
-        logger.info(f"   Activities: {activities_count}")
+        logger.info(f"   Companies: {counts['companies']}")
+        logger.info(f"   Contacts: {counts['contacts']}")
+        logger.info(f"   Deals: {counts['deals']}")
+        logger.info(f"   Activities: {counts['activities']}")
         logger.info("=" * 80)
     
     def incremental_sync(self):
@@ -1002,6 +1727,7 @@ class Bitrix24ETL:
         1. Обновляет справочники
         2. Обогащает существующие записи недостающими полями
         3. Загружает только измененные записи за последние HOURS_BACK часов
+        4. Пересчитывает паттерны только для изменённых сделок
         """
         logger.info("=" * 80)
         logger.info(f"🔄 SMART INCREMENTAL SYNC STARTED (last {HOURS_BACK}h)")
@@ -1019,18 +1745,25 @@ class Bitrix24ETL:
 
         # 3. Загрузить изменения за последние HOURS_BACK часов
         logger.info(f"📥 Loading changes from last {HOURS_BACK} hours...")
-        contacts_count = self.extract_contacts()
-        deals_count = self.extract_deals()
-        activities_count = self.extract_activities()
+        counts = self.run_extractors({
+            'contacts': self.extract_contacts,
+            'deals': self.extract_deals,
+            'activities': self.extract_activities,
+        })
 
+        # 4. Пересчитать паттерны только для затронутых сделок
+        if self.changed_deal_ids:
+            self.calculate_patterns(self.changed_deal_ids)
+
+        self.wait_sync_log()
         duration = time.time() - start_time
 
         logger.info("=" * 80)
         logger.info("✅ SMART INCREMENTAL SYNC COMPLETED")
         logger.info(f"   Duration: {duration:.2f}s")
-        logger.info(f"   Contacts updated: {contacts_count}")
-        logger.info(f"   Deals updated: {deals_count}")
-        logger.info(f"   Activities updated: {activities_count}")
+        logger.info(f"   Contacts updated: {counts['contacts']}")
+        logger.info(f"   Deals updated: {counts['deals']}")
+        logger.info(f"   Activities updated: {counts['activities']}")
         logger.info("=" * 80)
 
     def enrich_existing_records(self):
@@ -1050,41 +1783,41 @@ class Bitrix24ETL:
                 deal_ids = [d['id'] for d in deals_to_enrich.data]
                 logger.info(f"  Found {len(deal_ids)} deals to enrich")
 
-                # Загрузить эти сделки из Битрикса (по одной, т.к. batch filter не работает)
+                # Загрузить эти сделки из Битрикса: crm.deal.get по одной сделке (фильтр
+                # по списку ID не работает), но до BATCH_LIMIT подкоманд за запрос batch.json
                 enriched_count = 0
                 updates = []
 
-                for deal_id in deal_ids:
+                for i in range(0, len(deal_ids), BATCH_LIMIT):
+                    chunk = deal_ids[i:i + BATCH_LIMIT]
                     try:
-                        time.sleep(self.rate_limit_delay)
-                        url = f"{self.bitrix_url}crm.deal.get.json"
-                        response = requests.get(url, params={'id': deal_id}, timeout=30)
-                        response.raise_for_status()
-                        data = response.json()
-
-                        if 'result' in data and data['result']:
-                            deal = data['result']
-                            deal_update = {
-                                'id': self.safe_int(deal['ID']),
-                                'type_id': deal.get('TYPE_ID') or None,
-                                'category_id': self.safe_int(deal.get('CATEGORY_ID'))
-                            }
-                            updates.append(deal_update)
-                            enriched_count += 1
-
-                            # Вставляем батчами по 50
-                            if len(updates) >= 50:
-                                self.supabase.table('deals').upsert(updates).execute()
-                                logger.info(f"  ✅ Enriched {enriched_count}/{len(deal_ids)} deals")
-                                updates = []
-
+                        deals = self.bitrix_batch({
+                            str(deal_id): ('crm.deal.get', {'id': deal_id}) for deal_id in chunk
+                        })
                     except Exception as e:
-                        logger.warning(f"  ⚠️  Failed to enrich deal {deal_id}: {e}")
+                        logger.warning(f"  ⚠️  Failed to enrich deals {chunk[0]}..{chunk[-1]}: {e}")
                         continue
 
+                    for deal in deals.values():
+                        if not deal:
+                            continue
+                        deal_update = {
+                            'id': safe_int(deal['ID']),
+                            'type_id': deal.get('TYPE_ID') or None,
+                            'category_id': safe_int(deal.get('CATEGORY_ID'))
+                        }
+                        updates.append(deal_update)
+                        enriched_count += 1
+
+                    # Вставляем батчами
+                    if len(updates) >= UPSERT_BATCH:
+                        self.rest.upsert('deals', updates)
+                        logger.info(f"  ✅ Enriched {enriched_count}/{len(deal_ids)} deals")
+                        updates = []
+
                 # Вставить остаток
                 if updates:
-                    self.supabase.table('deals').upsert(updates).execute()
+                    self.rest.upsert('deals', updates)
                     logger.info(f"  ✅ Enriched {enriched_count}/{len(deal_ids)} deals (final batch)")
             else:
                 logger.info("  ✅ All deals already enriched")
@@ -1103,13 +1836,16 @@ def main():
     
     etl = Bitrix24ETL()
     
-    if SYNC_MODE == 'full':
-        etl.full_sync()
-    elif SYNC_MODE == 'incremental':
-        etl.incremental_sync()
-    else:
-        logger.error(f"❌ Unknown SYNC_MODE: {SYNC_MODE}")
-        sys.exit(1)
+    try:
+        if SYNC_MODE == 'full':
+            etl.full_sync()
+        elif SYNC_MODE == 'incremental':
+            etl.incremental_sync()
+        else:
+            logger.error(f"❌ Unknown SYNC_MODE: {SYNC_MODE}")
+            sys.exit(1)
+    finally:
+        etl.close()
     
     logger.info("🏁 ETL process finished")
 
@@ -117,6 +117,7 @@ CREATE TABLE companies (
     date_create TIMESTAMP,
     date_modify TIMESTAMP,
     raw_data JSONB,
+    row_hash TEXT, -- хэш загруженной строки: ETL не отправляет повторно неизменённые записи
     created_at TIMESTAMP DEFAULT NOW(),
     updated_at TIMESTAMP DEFAULT NOW()
 );
@@ -147,6 +148,7 @@ CREATE TABLE contacts (
     date_create TIMESTAMP,
     date_modify TIMESTAMP,
     raw_data JSONB,
+    row_hash TEXT, -- хэш загруженной строки: ETL не отправляет повторно неизменённые записи
     created_at TIMESTAMP DEFAULT NOW(),
     updated_at TIMESTAMP DEFAULT NOW()
 );
@@ -407,12 +409,13 @@ CREATE TABLE sync_log (
     entity_type TEXT NOT NULL, -- 'deals', 'activities', 'contacts', etc
     started_at TIMESTAMP DEFAULT NOW(),
     finished_at TIMESTAMP,
-    status TEXT, -- 'running', 'completed', 'failed'
+    status TEXT, -- 'completed', 'failed' (строка пишется по окончании синхронизации сущности)
     records_processed INTEGER DEFAULT 0,
     records_inserted INTEGER DEFAULT 0,
     records_updated INTEGER DEFAULT 0,
     records_failed INTEGER DEFAULT 0,
     error_message TEXT,
+    high_water TIMESTAMPTZ, -- Максимальная дата изменения среди загруженных записей (старт следующего incremental)
     metadata JSONB
 );
 
@@ -420,6 +423,10 @@ CREATE INDEX idx_sync_log_entity ON sync_log(entity_type);
 CREATE INDEX idx_sync_log_started ON sync_log(started_at);
 CREATE INDEX idx_sync_log_status ON sync_log(status);
 
+-- Миграция уже развёрнутой базы (без пересоздания таблиц):
+-- ALTER TABLE sync_log ADD COLUMN IF NOT EXISTS high_water TIMESTAMPTZ;
+-- Без колонки ETL пишет sync_log без high_water, а incremental берёт окно HOURS_BACK
+
 COMMENT ON TABLE sync_log IS 'Журнал синхронизации данных из Битрикс24';
 
 -- ============================================================================
@@ -507,6 +514,175 @@ $$ LANGUAGE plpgsql;
 
 COMMENT ON FUNCTION update_deal_patterns IS 'Пересчитывает паттерны для конкретной сделки';
 
+-- Пакетный пересчёт паттернов: один INSERT ... SELECT ... GROUP BY по всем сделкам
+-- (или только по p_deal_ids) вместо вызова update_deal_patterns на каждую сделку
+CREATE OR REPLACE FUNCTION refresh_deal_patterns(p_deal_ids INTEGER[] DEFAULT NULL)
+RETURNS INTEGER AS $$
+DECLARE
+    v_count INTEGER;
+BEGIN
+    INSERT INTO deal_patterns (
+        deal_id,
+        total_activities,
+        calls_count,
+        calls_incoming,
+        calls_outgoing,
+        emails_count,
+        emails_incoming,
+        emails_outgoing,
+        meetings_count,
+        tasks_count,
+        total_call_duration,
+        avg_call_duration,
+        touches_count,
+        last_activity_date,
+        deal_duration,
+        days_to_close
+    )
+    SELECT
+        d.id,
+        COUNT(*) as total_activities,
+        COUNT(*) FILTER (WHERE a.type_id = 2) as calls_count,
+        COUNT(*) FILTER (WHERE a.type_id = 2 AND a.direction = 2) as calls_incoming,
+        COUNT(*) FILTER (WHERE a.type_id = 2 AND a.direction = 1) as calls_outgoing,
+        COUNT(*) FILTER (WHERE a.type_id = 4) as emails_count,
+        COUNT(*) FILTER (WHERE a.type_id = 4 AND a.direction = 2) as emails_incoming,
+        COUNT(*) FILTER (WHERE a.type_id = 4 AND a.direction = 1) as emails_outgoing,
+        COUNT(*) FILTER (WHERE a.type_id = 1) as meetings_count,
+        COUNT(*) FILTER (WHERE a.type_id = 3) as tasks_count,
+        SUM(a.call_duration) FILTER (WHERE a.type_id = 2) as total_call_duration,
+        AVG(a.call_duration) FILTER (WHERE a.type_id = 2)::INTEGER as avg_call_duration,
+        COUNT(DISTINCT DATE(a.created)) as touches_count,
+        MAX(a.created) as last_activity_date,
+        d.closedate - d.date_create as deal_duration,
+        EXTRACT(DAY FROM d.closedate - d.date_create)::INTEGER as days_to_close
+    FROM activities a
+    JOIN deals d ON d.id = a.owner_id
+    WHERE a.owner_type_id = 2
+      AND (p_deal_ids IS NULL OR a.owner_id = ANY(p_deal_ids))
+    GROUP BY d.id, d.date_create, d.closedate
+    ON CONFLICT (deal_id) DO UPDATE SET
+        total_activities = EXCLUDED.total_activities,
+        calls_count = EXCLUDED.calls_count,
+        calls_incoming = EXCLUDED.calls_incoming,
+        calls_outgoing = EXCLUDED.calls_outgoing,
+        emails_count = EXCLUDED.emails_count,
+        emails_incoming = EXCLUDED.emails_incoming,
+        emails_outgoing = EXCLUDED.emails_outgoing,
+        meetings_count = EXCLUDED.meetings_count,
+        tasks_count = EXCLUDED.tasks_count,
+        total_call_duration = EXCLUDED.total_call_duration,
+        avg_call_duration = EXCLUDED.avg_call_duration,
+        touches_count = EXCLUDED.touches_count,
+        last_activity_date = EXCLUDED.last_activity_date,
+        deal_duration = EXCLUDED.deal_duration,
+        days_to_close = EXCLUDED.days_to_close,
+        updated_at = NOW();
+
+    GET DIAGNOSTICS v_count = ROW_COUNT;
+    RETURN v_count;
+END;
+$$ LANGUAGE plpgsql;
+
+COMMENT ON FUNCTION refresh_deal_patterns IS 'Пересчитывает паттерны пакетно: для всех сделок или для списка p_deal_ids';
+
+-- ============================================================================
+-- ФУНКЦИИ ДЛЯ ПАКЕТНОЙ ЗАГРУЗКИ
+-- ============================================================================
+
+-- Пакетный upsert контактов: один INSERT ... SELECT по JSONB-массиву вместо
+-- разбора каждой строки на стороне PostgREST
+CREATE OR REPLACE FUNCTION upsert_contacts(payload JSONB)
+RETURNS INTEGER AS $$
+DECLARE
+    v_count INTEGER;
+BEGIN
+    INSERT INTO contacts (
+        id, name, last_name, second_name, full_name, post, company_id,
+        phone, email, birthdate, source_id, source_description,
+        assigned_by_id, created_by_id, date_create, date_modify, raw_data, row_hash
+    )
+    SELECT
+        x.id, x.name, x.last_name, x.second_name, x.full_name, x.post, x.company_id,
+        x.phone, x.email, x.birthdate, x.source_id, x.source_description,
+        x.assigned_by_id, x.created_by_id, x.date_create, x.date_modify, x.raw_data, x.row_hash
+    FROM jsonb_populate_recordset(NULL::contacts, payload) AS x
+    ON CONFLICT (id) DO UPDATE SET
+        name = EXCLUDED.name,
+        last_name = EXCLUDED.last_name,
+        second_name = EXCLUDED.second_name,
+        full_name = EXCLUDED.full_name,
+        post = EXCLUDED.post,
+        company_id = EXCLUDED.company_id,
+        phone = EXCLUDED.phone,
+        email = EXCLUDED.email,
+        birthdate = EXCLUDED.birthdate,
+        source_id = EXCLUDED.source_id,
+        source_description = EXCLUDED.source_description,
+        assigned_by_id = EXCLUDED.assigned_by_id,
+        created_by_id = EXCLUDED.created_by_id,
+        date_create = EXCLUDED.date_create,
+        date_modify = EXCLUDED.date_modify,
+        -- STORE_RAW=false присылает строки без raw_data - сохранённый JSON не затираем
+        raw_data = COALESCE(EXCLUDED.raw_data, contacts.raw_data),
+        row_hash = EXCLUDED.row_hash,
+        updated_at = NOW();
+
+    GET DIAGNOSTICS v_count = ROW_COUNT;
+    RETURN v_count;
+END;
+$$ LANGUAGE plpgsql;
+
+COMMENT ON FUNCTION upsert_contacts IS 'Пакетный upsert контактов из JSONB-массива';
+
+-- Все существующие ID (и row_hash) одним значением: ETL загружает их на старте
+-- за один запрос вместо постраничного обхода таблиц (max-rows PostgREST)
+CREATE OR REPLACE FUNCTION existing_ids()
+RETURNS JSONB AS $$
+    SELECT jsonb_build_object(
+        'companies', (SELECT COALESCE(jsonb_agg(jsonb_build_array(id, row_hash)), '[]'::jsonb) FROM companies),
+        'contacts', (SELECT COALESCE(jsonb_agg(jsonb_build_array(id, row_hash)), '[]'::jsonb) FROM contacts),
+        'managers', (SELECT COALESCE(jsonb_agg(id), '[]'::jsonb) FROM managers)
+    );
+$$ LANGUAGE sql STABLE;
+
+COMMENT ON FUNCTION existing_ids IS 'ID и row_hash компаний и контактов, ID менеджеров - для кэша ETL';
+
+-- Заглушки для внешних ключей (менеджеры, компании, контакты) одним вызовом:
+-- ETL сбрасывает их перед каждым батчем записей. Реальные строки не перезаписываются
+CREATE OR REPLACE FUNCTION insert_stubs(payload JSONB)
+RETURNS INTEGER AS $$
+DECLARE
+    v_count INTEGER;
+    v_total INTEGER := 0;
+BEGIN
+    INSERT INTO managers (id, name, raw_data)
+    SELECT x.id, x.name, x.raw_data
+    FROM jsonb_populate_recordset(NULL::managers, COALESCE(payload->'managers', '[]'::jsonb)) AS x
+    ON CONFLICT (id) DO NOTHING;
+    GET DIAGNOSTICS v_count = ROW_COUNT;
+    v_total := v_total + v_count;
+
+    INSERT INTO companies (id, title, raw_data)
+    SELECT x.id, x.title, x.raw_data
+    FROM jsonb_populate_recordset(NULL::companies, COALESCE(payload->'companies', '[]'::jsonb)) AS x
+    ON CONFLICT (id) DO NOTHING;
+    GET DIAGNOSTICS v_count = ROW_COUNT;
+    v_total := v_total + v_count;
+
+    INSERT INTO contacts (id, name, raw_data)
+    SELECT x.id, x.name, x.raw_data
+    FROM jsonb_populate_recordset(NULL::contacts, COALESCE(payload->'contacts', '[]'::jsonb)) AS x
+    ON CONFLICT (id) DO NOTHING;
+    GET DIAGNOSTICS v_count = ROW_COUNT;
+    v_total := v_total + v_count;
+
+    RETURN v_total;
+END;
+$$ LANGUAGE plpgsql;
+
+COMMENT ON FUNCTION insert_stubs IS 'Пакетная вставка заглушек менеджеров, компаний и контактов из JSONB';
+
 -- ============================================================================
 -- ПРЕДСТАВЛЕНИЯ ДЛЯ АНАЛИТИКИ
 -- ============================================================================